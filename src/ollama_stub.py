@@ -0,0 +1,134 @@
+"""
+Servidor de modelo de sustitución compatible con la API de Ollama
+Responde a los prompts de SIPAC con respuestas válidas predefinidas, para
+probar en local el servicio y la ejecución distribuida sin un modelo real.
+
+Uso:
+    python ollama_stub.py --port 11501 --delay 0.5
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_RESPONSES = {
+    1: "Ampliar el alcance de la empresa para poder llegar a más clientes",
+    2: "Ampliar modelo de negocio (de tienda física a tienda online), Implementar un sistema CRM",
+    3: "Diversificación de servicios, Mejora del almacenamiento del conocimiento",
+    4: json.dumps(
+        [
+            {
+                "tipo_generico": 3,
+                "activo_especifico": "Creación de tienda online",
+                "importancia": 5,
+                "tipo_ci": "capital tecnológico",
+            },
+            {
+                "tipo_generico": 11,
+                "activo_especifico": "Base de datos de conocimiento",
+                "importancia": 4,
+                "tipo_ci": "capital organizativo",
+            },
+        ],
+        ensure_ascii=False,
+    ),
+}
+
+
+def stub_answer(messages: list) -> str:
+    """Devuelve la respuesta predefinida para el paso indicado en el prompt"""
+    for message in messages:
+        match = re.search(r"PASO (\d+) de", message.get("content", ""))
+        if match:
+            return STUB_RESPONSES.get(int(match.group(1)), "")
+    return "ok"
+
+
+def make_handler(model: str, delay: float, stats: dict):
+    class OllamaStubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, body: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path in ("/", "/api/tags", "/api/version"):
+                body = json.dumps({"models": [{"name": model, "model": model}], "version": "stub"})
+                return self._send(200, body.encode("utf-8"), "application/json")
+            self._send(404, b"{}", "application/json")
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+
+            if self.path != "/api/chat":
+                return self._send(404, b"{}", "application/json")
+
+            with stats["lock"]:
+                stats["requests"] += 1
+            time.sleep(delay)
+
+            created_at = datetime.now(timezone.utc).isoformat()
+            content = stub_answer(request.get("messages", []))
+            final = {
+                "model": request.get("model", model),
+                "created_at": created_at,
+                "message": {"role": "assistant", "content": content},
+                "done": True,
+                "done_reason": "stop",
+                "total_duration": int(delay * 1e9),
+                "prompt_eval_count": 0,
+                "eval_count": len(content.split()),
+            }
+
+            if request.get("stream", True):
+                chunk = dict(final, done=False)
+                chunk.pop("done_reason")
+                final["message"] = {"role": "assistant", "content": ""}
+                lines = [chunk, final]
+            else:
+                lines = [final]
+
+            body = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines)
+            self._send(200, body.encode("utf-8"), "application/x-ndjson")
+
+    return OllamaStubHandler
+
+
+def start_stub_server(port: int, model: str = "qwen3:8b", delay: float = 0.0, host: str = "127.0.0.1"):
+    """Arranca el servidor en un hilo y devuelve (servidor, estadísticas)"""
+    stats = {"requests": 0, "lock": threading.Lock()}
+    server = ThreadingHTTPServer((host, port), make_handler(model, delay, stats))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor Ollama de sustitución para SIPAC")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, nargs="+", default=[11434])
+    parser.add_argument("--model", default="qwen3:8b")
+    parser.add_argument("--delay", type=float, default=0.0, help="Latencia simulada (s)")
+    args = parser.parse_args()
+
+    for port in args.port:
+        start_stub_server(port, args.model, args.delay, args.host)
+        print(f"Stub Ollama escuchando en http://{args.host}:{port}")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
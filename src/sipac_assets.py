@@ -0,0 +1,270 @@
+"""
+SIPAC - Índice de normalización de activos específicos
+Asigna identificadores canónicos a los ``activo_especifico`` que propone el
+modelo, de modo que variantes como "Creación de tienda online" y "Tienda
+online" comparten id entre ejecuciones y clientes.
+
+La búsqueda se hace en dos niveles:
+    1. Hash exacto de la forma normalizada (minúsculas, sin tildes, sin
+       palabras vacías ni verbos de acción, tokens ordenados)
+    2. MinHash + LSH sobre 3-gramas de caracteres para variantes cercanas
+
+El índice se guarda en disco como un JSONL de solo añadido y se actualiza de
+forma incremental; varios procesos pueden compartir el mismo fichero.
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import unicodedata
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+NUM_PERM = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERM // LSH_BANDS
+SHINGLE_SIZE = 3
+FUZZY_THRESHOLD = 0.6
+
+# Palabras que no distinguen un activo de otro
+STOPWORDS = {
+    "a", "al", "con", "de", "del", "el", "en", "la", "las", "lo", "los",
+    "para", "por", "su", "sus", "un", "una", "unos", "unas", "y", "e", "o",
+}
+ACTION_WORDS = {
+    "creacion", "crear", "desarrollo", "desarrollar", "diseno", "implantacion",
+    "implementacion", "implementar", "mejora", "mejorar", "nuevo", "nueva",
+    "optimizacion", "puesta", "marcha",
+}
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(20240601)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERM)
+]
+
+
+# ============================================================================
+# NORMALIZACIÓN Y FIRMAS
+# ============================================================================
+
+
+def normalize_asset(text: str) -> str:
+    """Forma normalizada de un activo: tokens significativos, sin tildes y ordenados"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    tokens = re.findall(r"[a-z0-9]+", text)
+    meaningful = [t for t in tokens if t not in STOPWORDS and t not in ACTION_WORDS]
+    return " ".join(sorted(set(meaningful or tokens)))
+
+
+def exact_key(normalized: str) -> str:
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _shingles(normalized: str) -> set:
+    text = f" {normalized} "
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i : i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def _stable_hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=4).digest(), "big")
+
+
+def minhash_signature(normalized: str) -> List[int]:
+    """Firma MinHash de los 3-gramas de caracteres (estable entre procesos)"""
+    hashes = [_stable_hash(s) for s in _shingles(normalized)]
+    return [
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def signature_similarity(sig_a: List[int], sig_b: List[int]) -> float:
+    """Estimación de la similitud de Jaccard a partir de dos firmas"""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+def _band_keys(signature: List[int]) -> List[tuple]:
+    return [
+        (band, tuple(signature[band * LSH_ROWS : (band + 1) * LSH_ROWS]))
+        for band in range(LSH_BANDS)
+    ]
+
+
+# ============================================================================
+# ÍNDICE PERSISTENTE
+# ============================================================================
+
+
+class AssetIndex:
+    """
+    Índice persistente de activos canónicos.
+
+    Registros del fichero (JSONL, solo añadido):
+        {"type": "asset", "id", "canonical", "key", "signature"}
+        {"type": "alias", "id", "key"}
+
+    Los alias guardan las formas exactas ya vistas que se resolvieron por
+    similitud, para que la próxima vez se resuelvan por hash.
+    """
+
+    def __init__(self, path: Path, threshold: float = FUZZY_THRESHOLD):
+        self.path = Path(path)
+        self.threshold = threshold
+        self._by_key: dict[str, int] = {}
+        self._canonical: dict[int, str] = {}
+        self._signatures: dict[int, List[int]] = {}
+        self._buckets: dict[tuple, set] = {}
+        self._offset = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.touch(exist_ok=True)
+        with self._lock:
+            self._load_new_records()
+
+    def __len__(self) -> int:
+        return len(self._canonical)
+
+    def canonical(self, asset_id: int) -> Optional[str]:
+        """Descripción canónica (la primera vista) de un activo"""
+        return self._canonical.get(asset_id)
+
+    def _apply(self, record: dict):
+        self._by_key[record["key"]] = record["id"]
+        if record["type"] == "asset":
+            self._canonical[record["id"]] = record["canonical"]
+            self._signatures[record["id"]] = record["signature"]
+            for band_key in _band_keys(record["signature"]):
+                self._buckets.setdefault(band_key, set()).add(record["id"])
+
+    def _load_new_records(self):
+        """Aplica los registros añadidos al fichero (también por otros procesos)"""
+        with self.path.open("rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self._apply(json.loads(line))
+                self._offset += len(line)
+
+    def _append(self, records: List[dict]):
+        with self.path.open("a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        for record in records:
+            self._apply(record)
+        self._offset = self.path.stat().st_size
+
+    def _fuzzy_match(self, signature: List[int]) -> Optional[int]:
+        candidates = set()
+        for band_key in _band_keys(signature):
+            candidates |= self._buckets.get(band_key, set())
+
+        best_id, best_score = None, 0.0
+        for asset_id in sorted(candidates):
+            score = signature_similarity(signature, self._signatures[asset_id])
+            if score >= self.threshold and score > best_score:
+                best_id, best_score = asset_id, score
+        return best_id
+
+    def lookup(self, text: str) -> Optional[int]:
+        """Busca el id de un activo sin añadirlo al índice"""
+        normalized = normalize_asset(text)
+        with self._lock:
+            asset_id = self._by_key.get(exact_key(normalized))
+            if asset_id is None:
+                asset_id = self._fuzzy_match(minhash_signature(normalized))
+        return asset_id
+
+    def resolve(self, text: str) -> int:
+        """Devuelve el id canónico del activo, registrándolo si es nuevo"""
+        normalized = normalize_asset(text)
+        key = exact_key(normalized)
+
+        with self._lock:
+            asset_id = self._by_key.get(key)
+            if asset_id is not None:
+                return asset_id
+
+            signature = minhash_signature(normalized)
+            with _file_lock(self.path):
+                self._load_new_records()
+
+                asset_id = self._by_key.get(key)
+                if asset_id is not None:
+                    return asset_id
+
+                asset_id = self._fuzzy_match(signature)
+                if asset_id is not None:
+                    self._append([{"type": "alias", "id": asset_id, "key": key}])
+                    return asset_id
+
+                asset_id = max(self._canonical, default=0) + 1
+                self._append(
+                    [
+                        {
+                            "type": "asset",
+                            "id": asset_id,
+                            "canonical": text.strip(),
+                            "key": key,
+                            "signature": signature,
+                        }
+                    ]
+                )
+                return asset_id
+
+    def resolve_many(self, texts: Iterable[str]) -> List[int]:
+        return [self.resolve(text) for text in texts]
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """Bloqueo exclusivo del fichero del índice entre procesos (POSIX)"""
+    if fcntl is None:
+        yield
+        return
+    with Path(str(path) + ".lock").open("w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# ============================================================================
+# AGREGACIÓN
+# ============================================================================
+
+
+def aggregate_by_asset(results: Iterable[dict]) -> dict[int, dict]:
+    """
+    Agrega resultados de varias ejecuciones (formato de ``serialize_results``)
+    por id canónico: número de apariciones e importancia media.
+    """
+    aggregated: dict[int, dict] = {}
+    for result in results:
+        activos = result.get("activos") or {}
+        ids = activos.get("activo_id") or []
+        importancias = activos.get("importancia_activo") or []
+        for asset_id, importancia in zip(ids, importancias):
+            entry = aggregated.setdefault(asset_id, {"count": 0, "importancia_total": 0})
+            entry["count"] += 1
+            entry["importancia_total"] += importancia
+
+    for entry in aggregated.values():
+        entry["importancia_media"] = round(entry.pop("importancia_total") / entry["count"], 2)
+    return aggregated
@@ -3,15 +3,20 @@ SIPAC - Sistema Interactivo de Procesos con LangGraph
 Implementación completa usando arquitectura de grafos de estados
 """
 
-from typing import TypedDict, List, Literal, Annotated
+from typing import TypedDict, List, Literal, Annotated, Optional, Callable
+from collections import Counter
 from langgraph.graph import StateGraph, END
 from langgraph.graph.state import CompiledStateGraph
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
 #from langchain_google_generative_ai import ChatGoogleGenerativeAI
 from langchain_ollama import ChatOllama
 from dotenv import load_dotenv
 import operator
+import inspect
 import json
+from concurrent.futures import Future
 from pathlib import Path
 
 load_dotenv()
@@ -98,7 +103,17 @@ CI_TYPES = {
 
 RESULTS_DIR = Path(__file__).parent.parent / "results"
 
+ASSET_INDEX_PATH = RESULTS_DIR / "asset_index.jsonl"
+
 MAX_RETRIES = 5
+
+DEFAULT_MODEL = "qwen3:8b"
+
+# Self-consistency en el paso de activos (json_array)
+SELF_CONSISTENCY_SAMPLES = 5
+SAMPLING_TEMPERATURE = 0.7
+SELF_CONSISTENCY_STRATEGIES = ("best", "consensus")
+
 # ============================================================================
 # DEFINICIÓN DEL ESTADO
 # ============================================================================
@@ -120,6 +135,7 @@ class SipacState(TypedDict):
     activo_especifico: List[str]
     importancia_activo: List[int]  # Escala 1-5
     tipo_CI_Intellectus: List[str]  # Tipos de capital intelectual
+    activo_id: List[int]  # IDs canónicos del índice de activos (opcional)
 
     # Control de validación
     validation_error: str
@@ -130,6 +146,22 @@ class SipacState(TypedDict):
     completed: bool
 
 
+class SipacStreamingState(SipacState):
+    """
+    Estado de SIPAC cuando la salida de cada nodo se exporta según se emite:
+    ``messages`` y ``conversation_history`` guardan solo la última
+    actualización en lugar de acumularse durante toda la ejecución (los nodos
+    solo leen el último mensaje).
+    """
+
+    messages: List[BaseMessage]
+    conversation_history: List[dict]
+
+
+# Canales del estado que se acumulan (operator.add) en lugar de sobrescribirse
+ACCUMULATED_KEYS = ("messages", "conversation_history")
+
+
 # ============================================================================
 # DEFINICIÓN DE PASOS
 # ============================================================================
@@ -355,6 +387,346 @@ def validate_activos_json(value: str) -> tuple[bool, str, dict]:
         return False, f"Error al procesar: {str(e)}", {}
 
 
+def extract_response_text(message: BaseMessage) -> str:
+    """Obtiene el texto de la respuesta del LLM, sea string o lista de partes"""
+    if isinstance(message.content, list):
+        return " ".join(
+            str(part) if not isinstance(part, dict) else part.get("text", "")
+            for part in message.content
+        ).strip()
+    return message.content.strip()
+
+
+def precheck_response(step: dict, raw_response: str) -> bool:
+    """
+    Comprobación barata de que una respuesta probablemente pasará la validación.
+
+    Solo se usa para decidir si merece la pena lanzar la llamada especulativa
+    del siguiente paso; la validación completa sigue haciéndose en
+    ``validation_node``.
+    """
+    if step["type"] == "string":
+        return len(raw_response) >= step.get("min_length", 1)
+    if step["type"] == "list":
+        return bool(raw_response.replace(",", "").strip())
+    if step["type"] == "json_array":
+        return raw_response.startswith("[") and raw_response.endswith("]")
+    return False
+
+
+# ============================================================================
+# PREFETCH ESPECULATIVO
+# ============================================================================
+
+
+class SpeculativePrefetcher:
+    """
+    Lanza en segundo plano la llamada al LLM del siguiente paso mientras se
+    valida la respuesta del paso actual.
+
+    El prompt del primer intento de un paso solo depende del índice del paso
+    (sin ``validation_error``), así que puede construirse antes de conocer el
+    resultado de la validación. Si la validación falla, la llamada
+    especulativa se cancela o su resultado se descarta.
+
+    Una llamada descartada que ya estaba en curso no se puede interrumpir y
+    sigue ocupando un hilo hasta que termina; por eso el pool tiene dos hilos
+    y no se lanza nada nuevo mientras todos están ocupados con llamadas
+    descartadas (la nueva llamada esperaría detrás de ellas).
+
+    Se usa una instancia por ejecución, pasada en
+    ``config["configurable"]["speculative"]``.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self._executor = ContextThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sipac-speculative"
+        )
+        self._max_workers = max_workers
+        self._pending: dict[int, Future] = {}
+        self._discarded_running: List[Future] = []
+        self.hits = 0
+        self.discarded = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def start(self, step_index: int, llm):
+        """Lanza la llamada del primer intento del paso ``step_index``"""
+        if step_index >= len(STEPS) or step_index in self._pending:
+            return
+        self._discarded_running = [f for f in self._discarded_running if not f.done()]
+        if len(self._discarded_running) >= self._max_workers:
+            self.skipped += 1
+            return
+        messages = build_step_messages(step_index, {"validation_error": ""})
+        self._pending[step_index] = self._executor.submit(llm.invoke, messages)
+
+    def take(self, step_index: int) -> Optional[Future]:
+        """Recoge la llamada especulativa del paso, si existe"""
+        future = self._pending.pop(step_index, None)
+        if future is not None:
+            self.hits += 1
+        return future
+
+    def discard(self, step_index: int):
+        """Cancela (o ignora el resultado de) la llamada especulativa del paso"""
+        future = self._pending.pop(step_index, None)
+        if future is not None:
+            if not future.cancel():
+                self._discarded_running.append(future)
+            self.discarded += 1
+
+    def close(self):
+        for step_index in list(self._pending):
+            self.discard(step_index)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_prefetcher(config: Optional[RunnableConfig]) -> Optional[SpeculativePrefetcher]:
+    return (config or {}).get("configurable", {}).get("speculative")
+
+
+def with_prefetcher(
+    config: Optional[RunnableConfig], prefetcher: SpeculativePrefetcher
+) -> RunnableConfig:
+    """Devuelve una copia de ``config`` con el prefetcher especulativo"""
+    config = dict(config or {})
+    config["configurable"] = {**config.get("configurable", {}), "speculative": prefetcher}
+    return config
+
+
+# ============================================================================
+# SELF-CONSISTENCY (PASO DE ACTIVOS)
+# ============================================================================
+
+
+def normalize_self_consistency(value) -> Optional[dict]:
+    """
+    Normaliza la opción ``self_consistency``: ``None``/``False`` la desactivan,
+    ``True`` usa los valores por defecto y un dict puede indicar ``n`` y
+    ``strategy``. Lanza ``ValueError`` si los valores no son válidos.
+    """
+    if not value:
+        return None
+    settings = {} if value is True else dict(value)
+    n = settings.get("n", SELF_CONSISTENCY_SAMPLES)
+    strategy = settings.get("strategy", "best")
+    if not isinstance(n, int) or n < 1:
+        raise ValueError(f"self_consistency: 'n' debe ser un entero positivo, no {n!r}")
+    if strategy not in SELF_CONSISTENCY_STRATEGIES:
+        raise ValueError(
+            f"self_consistency: estrategia desconocida {strategy!r} "
+            f"(opciones: {', '.join(SELF_CONSISTENCY_STRATEGIES)})"
+        )
+    return {"n": n, "strategy": strategy}
+
+
+def get_self_consistency(config: Optional[RunnableConfig]) -> Optional[dict]:
+    """
+    Configuración del muestreo de candidatos, en
+    ``config["configurable"]["self_consistency"]``:
+
+        True | {"n": 5, "strategy": "best" | "consensus"}
+    """
+    return normalize_self_consistency(
+        (config or {}).get("configurable", {}).get("self_consistency")
+    )
+
+
+def uses_self_consistency(step_index: int, config: Optional[RunnableConfig]) -> bool:
+    """Indica si el paso se resuelve muestreando varios candidatos en paralelo"""
+    return (
+        step_index < len(STEPS)
+        and STEPS[step_index]["type"] == "json_array"
+        and bool(get_self_consistency(config))
+    )
+
+
+_SAMPLING_LLMS: dict[int, list] = {}
+
+
+def get_sampling_llms(config: Optional[RunnableConfig], n: int) -> list:
+    """
+    Modelos con los que se generan los ``n`` candidatos.
+
+    Se usan, por orden de preferencia, los de
+    ``config["configurable"]["sampling_llms"]`` (p. ej. varios modelos
+    distintos, repartidos de forma cíclica), copias del ``llm`` configurado
+    o ChatOllama por defecto, en ambos casos con temperatura
+    ``SAMPLING_TEMPERATURE`` y una semilla por candidato.
+
+    Muestrear ``n`` veces el mismo modelo determinista daría ``n`` candidatos
+    iguales, así que si el ``llm`` configurado no admite cambiar temperatura y
+    semilla se lanza ``ValueError``: hay que indicar ``sampling_llms``.
+    """
+    configurable = (config or {}).get("configurable", {})
+    llms = configurable.get("sampling_llms")
+    if not llms and configurable.get("llm") is not None:
+        llms = _sampling_variants(configurable["llm"], n)
+    if not llms:
+        if n not in _SAMPLING_LLMS:
+            _SAMPLING_LLMS[n] = [
+                ChatOllama(model=DEFAULT_MODEL, temperature=SAMPLING_TEMPERATURE, seed=i)
+                for i in range(n)
+            ]
+        llms = _SAMPLING_LLMS[n]
+    return [llms[i % len(llms)] for i in range(n)]
+
+
+def wrap_sampling_llms(
+    config: Optional[RunnableConfig], self_consistency, wrapper: Callable
+) -> tuple[Optional[dict], Optional[list]]:
+    """
+    Resuelve la configuración de self-consistency (el argumento
+    ``self_consistency`` de ``run_sipac`` o la de ``config``) y envuelve con
+    ``wrapper(llm, slot)`` el modelo de cada candidato, p. ej. para grabar o
+    medir sus llamadas; ``slot`` es el índice del candidato.
+
+    Returns:
+        (configuración normalizada, modelos envueltos), o (None, None) si el
+        muestreo no está activo
+    """
+    settings = normalize_self_consistency(self_consistency) or get_self_consistency(config)
+    if not settings:
+        return None, None
+    return settings, [
+        wrapper(llm, slot) for slot, llm in enumerate(get_sampling_llms(config, settings["n"]))
+    ]
+
+
+def _sampling_variants(llm, n: int) -> list:
+    """Copias de un chat model de LangChain con temperatura de muestreo y semilla propia"""
+    fields = getattr(type(llm), "model_fields", {})
+    if "temperature" not in fields or "seed" not in fields:
+        raise ValueError(
+            f"self_consistency: no se pueden muestrear candidatos distintos de "
+            f"{type(llm).__name__}; indica config['configurable']['sampling_llms']"
+        )
+    return [
+        llm.model_copy(update={"temperature": SAMPLING_TEMPERATURE, "seed": i})
+        for i in range(n)
+    ]
+
+
+def _asset_key(activo: dict) -> tuple:
+    return (activo["tipo_generico"], activo["tipo_CI_Intellectus"])
+
+
+def select_best_candidate(candidates: List[List[dict]]) -> List[dict]:
+    """
+    Elige el candidato válido más respaldado por el resto: cada activo suma
+    tantos puntos como candidatos contienen su par (tipo_generico, tipo_ci).
+    """
+    support = Counter(
+        key for activos in candidates for key in {_asset_key(a) for a in activos}
+    )
+    scores = [sum(support[_asset_key(a)] for a in activos) for activos in candidates]
+    return candidates[scores.index(max(scores))]
+
+
+def merge_candidates_by_consensus(candidates: List[List[dict]]) -> List[dict]:
+    """
+    Fusiona los candidatos válidos quedándose con los activos cuyo par
+    (tipo_generico, tipo_ci) aparece en la mayoría de ellos. Para cada par se
+    toma la descripción más repetida y la mediana de la importancia.
+    """
+    quorum = len(candidates) // 2 + 1
+    groups: dict[tuple, List[dict]] = {}
+    presence = Counter()
+
+    for activos in candidates:
+        for key in {_asset_key(a) for a in activos}:
+            presence[key] += 1
+        for activo in activos:
+            groups.setdefault(_asset_key(activo), []).append(activo)
+
+    merged = []
+    for key, activos in groups.items():
+        if presence[key] < quorum:
+            continue
+        descriptions = Counter(a["activo_especifico"] for a in activos)
+        importancias = sorted(a["importancia_activo"] for a in activos)
+        merged.append(
+            {
+                "tipo_generico": key[0],
+                "activo_especifico": descriptions.most_common(1)[0][0],
+                "importancia_activo": importancias[len(importancias) // 2],
+                "tipo_CI_Intellectus": key[1],
+            }
+        )
+    return merged
+
+
+def sample_activos_candidates(
+    step_index: int, state: SipacState, config: Optional[RunnableConfig]
+) -> tuple[AIMessage, dict]:
+    """
+    Genera ``n`` candidatos en paralelo para el paso de activos, los valida
+    con ``validate_activos_json`` y devuelve una única respuesta: el mejor
+    candidato válido o la fusión por consenso. Si ninguno es válido se
+    devuelve el primero, para que ``validation_node`` registre su error y
+    siga el flujo de reintentos habitual.
+
+    Un candidato cuya llamada falla cuenta como inválido; solo se propaga el
+    error si fallan todas.
+    """
+    settings = get_self_consistency(config)
+    n = settings["n"]
+    strategy = settings["strategy"]
+
+    messages = build_step_messages(step_index, state)
+    llms = get_sampling_llms(config, n)
+
+    responses, errors = [], []
+    with ContextThreadPoolExecutor(
+        max_workers=n, thread_name_prefix="sipac-sample"
+    ) as executor:
+        futures = [executor.submit(llm.invoke, messages) for llm in llms]
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except Exception as exc:
+                errors.append(exc)
+
+    if not responses:
+        raise errors[0]
+
+    valid = []
+    for response in responses:
+        is_valid, _, result = validate_activos_json(extract_response_text(response))
+        if is_valid:
+            valid.append(result["activos"])
+
+    stats = {
+        "candidates": n,
+        "failed_candidates": len(errors),
+        "valid_candidates": len(valid),
+        "strategy": strategy,
+    }
+    if not valid:
+        return responses[0], stats
+
+    activos = []
+    if strategy == "consensus":
+        activos = merge_candidates_by_consensus(valid)
+    if not activos:
+        activos = select_best_candidate(valid)
+
+    content = json.dumps(
+        [
+            {
+                "tipo_generico": a["tipo_generico"],
+                "activo_especifico": a["activo_especifico"],
+                "importancia": a["importancia_activo"],
+                "tipo_ci": a["tipo_CI_Intellectus"],
+            }
+            for a in activos
+        ],
+        ensure_ascii=False,
+    )
+    return AIMessage(content=content), stats
+
+
 # ============================================================================
 # NODOS DEL GRAFO
 # ============================================================================
@@ -404,16 +776,35 @@ Por favor, corrige tu respuesta siguiendo el formato y las reglas especificadas.
     return system_prompt
 
 
-def agent_input_node(state: SipacState) -> dict:
-    """Nodo que solicita input al LLM para el paso actual"""
-    llm = ChatOllama(model="qwen3:8b", temperature=0)
-    #llm = ChatGoogleGenerativeAI(model="gemini-3-flash-preview", temperature=0)
+def get_llm(config: Optional[RunnableConfig] = None):
+    """
+    Obtiene el modelo a usar en el nodo del agente.
 
-    step_index = state["current_step"]
+    Si la configuración de la ejecución trae un modelo en
+    ``config["configurable"]["llm"]`` se usa ese (por ejemplo, el planificador
+    con micro-batching del servicio); si no, se reutiliza un ChatOllama por
+    defecto en lugar de crear uno nuevo en cada llamada.
+    """
+    configurable = (config or {}).get("configurable", {})
+    llm = configurable.get("llm")
+    if llm is not None:
+        return llm
+    return _default_llm()
+
+
+_DEFAULT_LLM = None
 
-    if step_index >= len(STEPS):
-        return {}
 
+def _default_llm():
+    global _DEFAULT_LLM
+    if _DEFAULT_LLM is None:
+        _DEFAULT_LLM = ChatOllama(model=DEFAULT_MODEL, temperature=0)
+        #_DEFAULT_LLM = ChatGoogleGenerativeAI(model="gemini-3-flash-preview", temperature=0)
+    return _DEFAULT_LLM
+
+
+def build_step_messages(step_index: int, state: SipacState) -> List[BaseMessage]:
+    """Construye los mensajes que se envían al LLM para un paso"""
     step = STEPS[step_index]
 
     # Crear prompt del sistema,
@@ -433,23 +824,71 @@ def agent_input_node(state: SipacState) -> dict:
             )
         )
 
-    # Invocar LLM
-    response = llm.invoke(messages)
+    return messages
+
+
+def agent_input_node(state: SipacState, config: RunnableConfig = None) -> dict:
+    """Nodo que solicita input al LLM para el paso actual"""
+    llm = get_llm(config)
+
+    step_index = state["current_step"]
+
+    if step_index >= len(STEPS):
+        return {}
+
+    step = STEPS[step_index]
+
+    prefetcher = get_prefetcher(config)
+    speculative = None
+    if prefetcher is not None and not state.get("validation_error"):
+        speculative = prefetcher.take(step_index)
+
+    sampling_stats = None
+
+    # Invocar LLM (o recoger la llamada especulativa ya lanzada)
+    if uses_self_consistency(step_index, config):
+        response, sampling_stats = sample_activos_candidates(step_index, state, config)
+    else:
+        response = None
+        if speculative is not None:
+            try:
+                response = speculative.result()
+            except Exception:
+                # La llamada especulativa falló: se repite de forma síncrona
+                prefetcher.failed += 1
+        if response is None:
+            messages = build_step_messages(step_index, state)
+            response = llm.invoke(messages)
+
+    # Adelantar el siguiente paso si la respuesta supera la comprobación rápida
+    if (
+        prefetcher is not None
+        and not uses_self_consistency(step_index + 1, config)
+        and precheck_response(step, extract_response_text(response))
+    ):
+        prefetcher.start(step_index + 1, llm)
+
+    history_entry = {
+        "step": step_index,
+        "step_name": step["title"],
+        "prompt": step["prompt"],
+        "response": response.content,
+    }
+    if sampling_stats is not None:
+        history_entry["self_consistency"] = sampling_stats
 
     return {
         "messages": [response],
-        "conversation_history": [
-            {
-                "step": step_index,
-                "step_name": step["title"],
-                "prompt": step["prompt"],
-                "response": response.content,
-            }
-        ],
+        "conversation_history": [history_entry],
     }
 
 
-def validation_node(state: SipacState) -> dict:
+def get_asset_index(config: Optional[RunnableConfig]):
+    """Índice de normalización de activos (``sipac_assets.AssetIndex``), si se configuró"""
+    return (config or {}).get("configurable", {}).get("asset_index")
+
+
+def validation_node(state: SipacState, config: RunnableConfig = None) -> dict:
     """Nodo que valida la respuesta del agente"""
     step_index = state["current_step"]
     step = STEPS[step_index]
@@ -461,16 +900,24 @@ def validation_node(state: SipacState) -> dict:
         }
 
     # Obtener última respuesta
-    last_message = state["messages"][-1]
+    raw_response = extract_response_text(state["messages"][-1])
 
-    if isinstance(last_message.content, list):
-        raw_response = " ".join(
-            str(part) if not isinstance(part, dict) else part.get("text", "")
-            for part in last_message.content
-        ).strip()
-    else:
-        raw_response = last_message.content.strip()
+    result = _validate_step(step_index, step, state, raw_response)
+
+    # Asignar ids canónicos a los activos validados
+    asset_index = get_asset_index(config)
+    if asset_index is not None and "activo_especifico" in result:
+        result["activo_id"] = asset_index.resolve_many(result["activo_especifico"])
+
+    # Si el paso no se supera, la llamada especulativa del siguiente no sirve
+    prefetcher = get_prefetcher(config)
+    if prefetcher is not None and result.get("validation_error"):
+        prefetcher.discard(step_index + 1)
+
+    return result
 
+
+def _validate_step(step_index: int, step: dict, state: SipacState, raw_response: str) -> dict:
     # Validar según el tipo de pasoº
     if step["type"] == "string":
         is_valid, error = validate_string(raw_response, step.get("min_length", 1))
@@ -548,6 +995,10 @@ def analysis_node(state: SipacState) -> dict:
     activo_especifico = state.get("activo_especifico", [])
     importancia = state.get("importancia_activo", [])
     tipo_ci = state.get("tipo_CI_Intellectus", [])
+    activo_id = state.get("activo_id", [])
+
+    if activo_id:
+        analysis["resumen_inputs"]["num_activos_unicos"] = len(set(activo_id))
 
     for i in range(len(tipo_generico)):
         activo_data = {
@@ -560,6 +1011,8 @@ def analysis_node(state: SipacState) -> dict:
             "importancia": importancia[i],
             "tipo_capital_intelectual": tipo_ci[i],
         }
+        if activo_id:
+            activo_data["activo_id"] = activo_id[i]
         analysis["activos_identificados"].append(activo_data)
 
     # # Calcular métricas
@@ -661,21 +1114,61 @@ def should_retry(state: SipacState) -> Literal["agent", "analysis", "error"]:
     return "agent"
 
 
+def should_retry_streaming(state: SipacStreamingState) -> Literal["agent", "analysis", "error"]:
+    """
+    ``should_retry`` para el grafo con ``SipacStreamingState``. LangGraph
+    deduce el esquema de entrada de la rama de la anotación de ``state``, y
+    con ``SipacState`` declararía los canales acumulativos de ``messages`` y
+    ``conversation_history``, incompatibles con los de este grafo.
+    """
+    return should_retry(state)
+
+
 # ============================================================================
 # CONSTRUCCIÓN DEL GRAFO
 # ============================================================================
 
 
-def create_sipac_graph() -> CompiledStateGraph:
-    """Crea y configura el grafo completo de SIPAC"""
+def call_node(node: Callable, state: SipacState, config: Optional[RunnableConfig] = None) -> dict:
+    """Invoca un nodo pasándole ``config`` solo si su firma lo admite"""
+    if "config" in inspect.signature(node).parameters:
+        return node(state, config)
+    return node(state)
 
-    workflow = StateGraph(SipacState)
+
+def create_sipac_graph(
+    node_wrapper: Optional[Callable] = None, accumulate: bool = True
+) -> CompiledStateGraph:
+    """
+    Crea y configura el grafo completo de SIPAC
+
+    Args:
+        node_wrapper: Función opcional ``(nombre, nodo) -> nodo`` que envuelve
+            cada nodo (p. ej. para grabar trazas o perfilar). El nodo devuelto
+            debe aceptar ``(state, config)``; ver ``call_node``
+        accumulate: Si False, el grafo no acumula ``messages`` ni
+            ``conversation_history`` (ver ``SipacStreamingState``)
+    """
+
+    state_schema = SipacState if accumulate else SipacStreamingState
+    workflow = StateGraph(state_schema)
+
+    nodes = {
+        "agent": agent_input_node,
+        "validation": validation_node,
+        "analysis": analysis_node,
+        "error": error_node,
+    }
 
     # Añadir nodos
-    workflow.add_node("agent", agent_input_node)
-    workflow.add_node("validation", validation_node)
-    workflow.add_node("analysis", analysis_node)
-    workflow.add_node("error", error_node)
+    # El esquema de entrada se indica explícitamente: LangGraph lo deduciría de
+    # la anotación ``SipacState`` de los nodos, con los canales acumulativos
+    for name, node in nodes.items():
+        workflow.add_node(
+            name,
+            node_wrapper(name, node) if node_wrapper else node,
+            input_schema=state_schema,
+        )
 
     # Punto de entrada
     workflow.set_entry_point("agent")
@@ -683,10 +1176,11 @@ def create_sipac_graph() -> CompiledStateGraph:
     # Flujo principal: agent -> validation
     workflow.add_edge("agent", "validation")
 
-    # Desde validation, decidir qué hacer
+    # Desde validation, decidir qué hacer (con la misma anotación de esquema
+    # que el grafo, por el mismo motivo que en los nodos)
     workflow.add_conditional_edges(
         "validation",
-        should_retry,
+        should_retry if accumulate else should_retry_streaming,
         {
             "agent": "agent",  # Reintentar el paso actual
             "analysis": "analysis",  # Ir a análisis final
@@ -706,29 +1200,80 @@ def create_sipac_graph() -> CompiledStateGraph:
 # ============================================================================
 
 
-def run_sipac(initial_state: dict = {}, stream: bool = True) -> dict:
+def default_initial_state() -> dict:
+    """Estado inicial por defecto de una ejecución de SIPAC"""
+    return {
+        "current_step": 0,
+        "messages": [],
+        "conversation_history": [],
+        "validation_error": "",
+        "retry_count": 0,
+        "completed": False,
+    }
+
+
+def run_sipac(
+    initial_state: dict = {},
+    stream: bool = True,
+    graph: Optional[CompiledStateGraph] = None,
+    config: Optional[RunnableConfig] = None,
+    speculative: bool = False,
+    self_consistency: Optional[dict | bool] = None,
+    exporter=None,
+) -> dict:
     """
     Ejecuta el flujo completo de SIPAC
 
     Args:
         initial_state: Estado inicial (opcional, para testing)
         stream: Si True, imprime el progreso paso a paso
+        graph: Grafo ya compilado a reutilizar (opcional)
+        config: Configuración de LangGraph, p. ej. {"configurable": {"llm": ...}}
+        speculative: Si True, lanza la llamada del siguiente paso mientras se
+            valida el actual (ver ``SpeculativePrefetcher``)
+        self_consistency: Si se indica, p. ej. {"n": 5, "strategy": "consensus"}
+            o True (valores por defecto), el paso de activos muestrea varios
+            candidatos en paralelo
+        exporter: Exportador opcional (ver ``sipac_export.StreamingExporter``)
+            que recibe la salida de cada nodo según se emite. Con exportador,
+            ni el grafo ni el estado final devuelto acumulan ``messages`` ni
+            ``conversation_history``, que quedan solo en el fichero exportado.
+            Si se pasa ``graph``, debe crearse con
+            ``create_sipac_graph(accumulate=False)``
 
     Returns:
         Estado final con los resultados del análisis
     """
-    graph = create_sipac_graph()
+    if graph is None:
+        graph = create_sipac_graph(accumulate=exporter is None)
+
+    self_consistency = normalize_self_consistency(self_consistency)
+    if self_consistency:
+        config = dict(config or {})
+        config["configurable"] = {
+            **config.get("configurable", {}),
+            "self_consistency": self_consistency,
+        }
+
+    if speculative:
+        prefetcher = SpeculativePrefetcher()
+        try:
+            return run_sipac(
+                initial_state,
+                stream=stream,
+                graph=graph,
+                config=with_prefetcher(config, prefetcher),
+                exporter=exporter,
+            )
+        finally:
+            prefetcher.close()
 
     # Estado inicial por defecto
     if initial_state == {}:
-        initial_state = {
-            "current_step": 0,
-            "messages": [],
-            "conversation_history": [],
-            "validation_error": "",
-            "retry_count": 0,
-            "completed": False,
-        }
+        initial_state = default_initial_state()
+
+    if not stream and exporter is None:
+        return graph.invoke(initial_state, config)
 
     if stream:
         print("=" * 70)
@@ -736,44 +1281,110 @@ def run_sipac(initial_state: dict = {}, stream: bool = True) -> dict:
         print("=" * 70)
         print(f"\nIniciando proceso con {len(STEPS)} pasos...\n")
 
-        final_state = {}
-        for step_output in graph.stream(initial_state):
-            node_name = list(step_output.keys())[0]
-            node_state = step_output[node_name]
-
-            # Mostrar progreso
-            if node_name == "agent":
-                step_idx = node_state["conversation_history"][0]["step"]
-                if step_idx < len(STEPS):
-                    print(f"\n{'─' * 70}")
-                    print(
-                        f" PASO {step_idx + 1}/{len(STEPS)}: {STEPS[step_idx]['title']}"
-                    )
-                    print(f"{'─' * 70}")
-
-            # Mostrar respuesta del agente
-            if node_state.get("messages"):
-                last_msg = node_state["messages"][-1]
-                if isinstance(last_msg, AIMessage):
-                    print(
-                        f"\n Respuesta: {last_msg.content[:200]}{'...' if len(last_msg.content) > 200 else ''}"
-                    )
-
-            # Mostrar errores de validación
-            if node_state.get("validation_error"):
-                print(f"\n  Error de validación: {node_state['validation_error']}")
-                print(f"   Reintento {node_state.get('retry_count', 0)}/{MAX_RETRIES}")
-
-            final_state = node_state
-
-        return final_state
-    else:
-        return graph.invoke(initial_state)
+    accumulate = exporter is None
+    final_state = merge_state_update({}, initial_state, accumulate=accumulate)
+
+    for step_output in graph.stream(initial_state, config):
+        node_name = list(step_output.keys())[0]
+        node_state = step_output[node_name] or {}
+
+        if exporter is not None:
+            exporter.write_node(node_name, node_state)
+
+        merge_state_update(final_state, node_state, accumulate=accumulate)
+
+        if not stream:
+            continue
+
+        # Mostrar progreso
+        if node_name == "agent":
+            step_idx = node_state["conversation_history"][0]["step"]
+            if step_idx < len(STEPS):
+                print(f"\n{'─' * 70}")
+                print(
+                    f" PASO {step_idx + 1}/{len(STEPS)}: {STEPS[step_idx]['title']}"
+                )
+                print(f"{'─' * 70}")
+
+        # Mostrar respuesta del agente
+        if node_state.get("messages"):
+            last_msg = node_state["messages"][-1]
+            if isinstance(last_msg, AIMessage):
+                print(
+                    f"\n Respuesta: {last_msg.content[:200]}{'...' if len(last_msg.content) > 200 else ''}"
+                )
+
+        # Mostrar errores de validación
+        if node_state.get("validation_error"):
+            print(f"\n  Error de validación: {node_state['validation_error']}")
+            print(f"   Reintento {node_state.get('retry_count', 0)}/{MAX_RETRIES}")
+
+    if exporter is not None:
+        result = serialize_results(final_state)
+        result.pop("conversation_history")
+        result["completed"] = final_state.get("completed", False)
+        exporter.write_result(result)
+
+    return final_state
+
+
+def merge_state_update(state: dict, update: dict, accumulate: bool = True) -> dict:
+    """
+    Aplica la salida de un nodo sobre ``state`` igual que el grafo: los canales
+    de ``ACCUMULATED_KEYS`` se amplían en el sitio y el resto se sobrescribe.
+    Con ``accumulate=False`` los canales acumulativos se descartan.
+    """
+    for key, value in update.items():
+        if key in ACCUMULATED_KEYS:
+            if accumulate:
+                if key not in state:
+                    # Copia propia, para no modificar la lista del llamante
+                    state[key] = []
+                state[key].extend(value)
+        else:
+            state[key] = value
+    return state
+
+
+def serialize_results(final_state: dict) -> dict:
+    """Selecciona la parte exportable (serializable a JSON) del estado final"""
+    return {
+        "inputs": {
+            "objetivo_negocio": final_state.get("objetivo_negocio"),
+            "requisitos_de_negocio": final_state.get("requisitos_de_negocio"),
+            "procesos": final_state.get("procesos"),
+        },
+        "activos": {
+            "tipo_generico": final_state.get("tipo_generico"),
+            "activo_especifico": final_state.get("activo_especifico"),
+            "importancia_activo": final_state.get("importancia_activo"),
+            "tipo_CI_Intellectus": final_state.get("tipo_CI_Intellectus"),
+            "activo_id": final_state.get("activo_id"),
+        },
+        "analysis": final_state.get("analysis_results"),
+        "conversation_history": final_state.get("conversation_history", []),
+    }
 
 
 if __name__ == "__main__":
+    from sipac_assets import AssetIndex
+    from sipac_export import StreamingExporter
+
+    # Cada nodo se exporta en cuanto termina, sin acumular el historial
+    results_path = Path(RESULTS_DIR)
+    results_path.mkdir(exist_ok=True)
+    output_file = results_path / "sipac_results.ndjson"
+
+    if output_file.exists():
+        counter = 1
+        while (results_path / f"sipac_results_{counter}.ndjson").exists():
+            counter += 1
+        output_file = results_path / f"sipac_results_{counter}.ndjson"
+
     # Ejecutar SIPAC
-    final_state = run_sipac(stream=True)
+    config = {"configurable": {"asset_index": AssetIndex(ASSET_INDEX_PATH)}}
+    with StreamingExporter(output_file) as exporter:
+        final_state = run_sipac(stream=True, config=config, exporter=exporter)
 
     # Mostrar resultados
     print("\n" + "=" * 70)
@@ -795,38 +1406,4 @@ if __name__ == "__main__":
             )
         )
 
-    # Exportar resultados
-
-    results_path = Path(RESULTS_DIR)
-    results_path.mkdir(exist_ok=True)
-    output_file = results_path / "sipac_results.json"
-
-    if output_file.exists():
-        counter = 1
-        while (results_path / f"sipac_results_{counter}.json").exists():
-            counter += 1
-        output_file = results_path / f"sipac_results_{counter}.json"
-
-    with output_file.open("w", encoding="utf-8") as f:
-        json.dump(
-            {
-                "inputs": {
-                    "objetivo_negocio": final_state.get("objetivo_negocio"),
-                    "requisitos_de_negocio": final_state.get("requisitos_de_negocio"),
-                    "procesos": final_state.get("procesos"),
-                },
-                "activos": {
-                    "tipo_generico": final_state.get("tipo_generico"),
-                    "activo_especifico": final_state.get("activo_especifico"),
-                    "importancia_activo": final_state.get("importancia_activo"),
-                    "tipo_CI_Intellectus": final_state.get("tipo_CI_Intellectus"),
-                },
-                "analysis": final_state.get("analysis_results"),
-                "conversation_history": final_state.get("conversation_history", []),
-            },
-            f,
-            indent=2,
-            ensure_ascii=False,
-        )
-
     print(f"\n Resultados exportados a: {output_file}")
@@ -0,0 +1,153 @@
+"""
+SIPAC - Exportación en streaming
+Escribe la salida de cada nodo en NDJSON según la va emitiendo el grafo, con
+un índice de desplazamientos para acceso aleatorio, de modo que ni el
+historial de conversación ni el documento de resultados completo tienen que
+estar en memoria.
+
+Ficheros generados:
+    sipac_results.ndjson        Un registro JSON por línea
+    sipac_results.ndjson.idx    Índice NDJSON: {"seq", "type", "node", "step", "offset", "length"}
+
+Registros:
+    {"type": "node",   "seq", "node", "delta"}
+    {"type": "result", "seq", "inputs", "activos", "analysis", "completed"}
+"""
+
+import json
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from langchain_core.messages import BaseMessage
+
+
+def compact_value(value):
+    """Convierte la salida de un nodo a JSON, reduciendo los mensajes a tipo y contenido"""
+    if isinstance(value, BaseMessage):
+        return {"type": value.type, "content": value.content}
+    if isinstance(value, dict):
+        return {k: compact_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [compact_value(v) for v in value]
+    return value
+
+
+def index_path_for(path: Path) -> Path:
+    return Path(str(path) + ".idx")
+
+
+class StreamingExporter:
+    """
+    Exportador incremental para ``run_sipac(exporter=...)``.
+
+    Cada registro se escribe y se vuelca a disco en cuanto llega, y el índice
+    guarda su desplazamiento y longitud en bytes.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._data = self.path.open("wb")
+        self._index = index_path_for(self.path).open("w", encoding="utf-8")
+        self._seq = 0
+
+    def _write(self, record: dict, node: Optional[str] = None, step: Optional[int] = None):
+        self._seq += 1
+        record = {"type": record.pop("type"), "seq": self._seq, **record}
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+        offset = self._data.tell()
+        self._data.write(line)
+        self._data.flush()
+
+        entry = {
+            "seq": self._seq,
+            "type": record["type"],
+            "node": node,
+            "step": step,
+            "offset": offset,
+            "length": len(line),
+        }
+        self._index.write(json.dumps(entry) + "\n")
+        self._index.flush()
+
+    def write_node(self, node_name: str, node_state: dict):
+        step = None
+        if node_state.get("conversation_history"):
+            step = node_state["conversation_history"][-1].get("step")
+        self._write(
+            {"type": "node", "node": node_name, "delta": compact_value(node_state)},
+            node=node_name,
+            step=step,
+        )
+
+    def write_result(self, result: dict):
+        self._write({"type": "result", **compact_value(result)})
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ============================================================================
+# LECTURA
+# ============================================================================
+
+
+def read_index(path: Path) -> List[dict]:
+    """Carga el índice de una exportación (una entrada pequeña por registro)"""
+    with index_path_for(path).open(encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_record(path: Path, entry: dict) -> dict:
+    """Lee un único registro usando su entrada del índice"""
+    with Path(path).open("rb") as f:
+        f.seek(entry["offset"])
+        return json.loads(f.read(entry["length"]))
+
+
+def read_result(path: Path) -> Optional[dict]:
+    """Devuelve el estado final fusionado sin recorrer todo el fichero"""
+    for entry in reversed(read_index(path)):
+        if entry["type"] == "result":
+            return read_record(path, entry)
+    return None
+
+
+def iter_records(path: Path, node: Optional[str] = None) -> Iterator[dict]:
+    """Recorre los registros en orden, opcionalmente solo los de un nodo"""
+    with Path(path).open(encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if node is None or record.get("node") == node:
+                yield record
+
+
+def export_legacy_json(path: Path, output_file: Path):
+    """
+    Convierte una exportación NDJSON al formato JSON de ``sipac_results.json``
+    escribiendo el historial de conversación entrada a entrada.
+    """
+    result = read_result(path) or {}
+
+    with Path(output_file).open("w", encoding="utf-8") as f:
+        f.write("{\n")
+        for key in ("inputs", "activos", "analysis"):
+            value = json.dumps(result.get(key), indent=2, ensure_ascii=False)
+            f.write(f'  "{key}": {value.replace(chr(10), chr(10) + "  ")},\n')
+
+        f.write('  "conversation_history": [')
+        first = True
+        for record in iter_records(path, node="agent"):
+            for entry in record["delta"].get("conversation_history", []):
+                f.write("\n    " if first else ",\n    ")
+                f.write(json.dumps(entry, ensure_ascii=False))
+                first = False
+        f.write("\n  ]\n}\n" if not first else "]\n}\n")
@@ -0,0 +1,586 @@
+"""
+SIPAC - Perfilado del runtime del grafo
+Modo opcional que reparte el tiempo de una ejecución entre la sobrecarga de
+LangGraph, cada nodo, la construcción de prompts (``create_step_prompt``), el
+parseo JSON (``validate_activos_json``) y la espera al LLM. Incluye un
+perfilador de CPU por muestreo con exportación a flamegraph (folded stacks) y
+speedscope y, opcionalmente, snapshots de tracemalloc por nodo.
+
+La memoria se mide en una pasada aparte (``--memory``): tracemalloc ralentiza
+cada asignación y los snapshots por nodo dominan el tiempo de la ejecución,
+así que con él activo el desglose de tiempos no es representativo.
+
+Uso:
+    python sipac_profile.py                                # contra el modelo
+    python sipac_profile.py --replay trazas.jsonl.gz       # sin modelo (ver sipac_trace)
+    python sipac_profile.py --replay trazas.jsonl.gz --memory   # pasada de memoria
+
+Ficheros generados por ejecución (en ``RESULTS_DIR/profiles``):
+    <id>.report.json        Desglose de tiempos y memoria
+    <id>.folded             Pilas agregadas (flamegraph.pl, speedscope)
+    <id>.speedscope.json    Perfil muestreado para https://www.speedscope.app
+"""
+
+import argparse
+import contextvars
+import functools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
+
+from langchain_core.runnables import RunnableConfig
+
+import sipac_chain
+from sipac_chain import (
+    RESULTS_DIR,
+    call_node,
+    create_sipac_graph,
+    default_initial_state,
+    get_llm,
+    run_sipac,
+    wrap_sampling_llms,
+)
+from sipac_trace import read_trace, replay_configurable
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Marcos (fichero, función) en los que un hilo está esperando sin usar CPU
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("thread.py", "_worker"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("socket.py", "readinto"),
+    ("socketserver.py", "serve_forever"),
+}
+
+# Funciones de sipac_chain que se cronometran durante el perfilado
+INSTRUMENTED_FUNCTIONS = {
+    "create_step_prompt": "prompt",
+    "validate_activos_json": "json_parse",
+}
+# Categorías que se descuentan del tiempo propio del nodo que las llama
+NODE_SUBCATEGORIES = ("llm_wait", "prompt", "json_parse")
+
+# Sesión de perfilado de la ejecución en curso. Las funciones de
+# ``INSTRUMENTED_FUNCTIONS`` solo se cronometran en los contextos que la tienen
+# (la ejecución perfilada y sus hilos auxiliares), no en otras ejecuciones
+# concurrentes del mismo proceso
+_current_session: contextvars.ContextVar[Optional["ProfileSession"]] = contextvars.ContextVar(
+    "sipac_profile_session", default=None
+)
+_instrumentation_lock = threading.Lock()
+_instrumented = False
+
+# Nodo del grafo en curso. Los hilos auxiliares (candidatos de
+# self-consistency, llamadas especulativas) lo heredan porque sipac_chain los
+# lanza con ``ContextThreadPoolExecutor``
+_current_node: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "sipac_profile_node", default=None
+)
+
+# ============================================================================
+# PERFILADOR DE CPU POR MUESTREO
+# ============================================================================
+
+
+class StackSampler(threading.Thread):
+    """
+    Muestrea periódicamente las pilas de los hilos del proceso con
+    ``sys._current_frames()`` y las agrega en formato folded.
+
+    Es un perfil de CPU: en cada tick se descartan los hilos detenidos en una
+    espera conocida (``IDLE_FRAMES``) y, donde el sistema ofrece reloj de CPU
+    por hilo, los que no han consumido CPU desde el tick anterior. Así no
+    aparecen los hilos ociosos de los pools ni los bloqueados en
+    ``future.result()`` o en la respuesta del LLM. También se descartan las
+    muestras del propio perfilador (snapshots de tracemalloc, contabilidad)
+    y se quitan de las pilas los marcos de este módulo.
+    """
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        super().__init__(name="sipac-sampler", daemon=True)
+        self.interval = interval
+        self.samples: dict[tuple, int] = {}
+        self.num_samples = 0
+        self._cpu_times: dict[int, float] = {}
+        self._stopped = threading.Event()
+
+    def _is_running(self, thread_id: int, frame) -> bool:
+        """Indica si el hilo ha usado CPU desde el tick anterior y no está esperando"""
+        code = frame.f_code
+        if (Path(code.co_filename).name, code.co_name) in IDLE_FRAMES:
+            return False
+        if not hasattr(time, "pthread_getcpuclockid"):
+            return True
+        try:
+            cpu = time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+        except (OSError, OverflowError):
+            return False
+        previous = self._cpu_times.get(thread_id)
+        self._cpu_times[thread_id] = cpu
+        return previous is not None and cpu > previous
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or not self._is_running(thread_id, frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack = _strip_profiler_frames(stack)
+                if stack is None:
+                    continue
+                stack.append((names.get(thread_id, str(thread_id)), "", 0))
+                key = tuple(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.num_samples += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    @staticmethod
+    def _frame_label(frame: tuple) -> str:
+        name, filename, line = frame
+        if not filename:
+            return name
+        return f"{name} ({Path(filename).name}:{line})"
+
+    def write_folded(self, path: Path):
+        """Formato de flamegraph.pl: ``marco;marco;... recuento``"""
+        with Path(path).open("w", encoding="utf-8") as f:
+            for stack, count in sorted(self.samples.items(), key=lambda i: -i[1]):
+                f.write(";".join(self._frame_label(fr) for fr in stack) + f" {count}\n")
+
+    def write_speedscope(self, path: Path, name: str):
+        """Perfil ``sampled`` en el formato de fichero de speedscope"""
+        frames: List[dict] = []
+        frame_ids: dict[tuple, int] = {}
+        samples, weights = [], []
+
+        for stack, count in self.samples.items():
+            ids = []
+            for frame in stack:
+                if frame not in frame_ids:
+                    frame_ids[frame] = len(frames)
+                    entry = {"name": frame[0]}
+                    if frame[1]:
+                        entry.update({"file": frame[1], "line": frame[2]})
+                    frames.append(entry)
+                ids.append(frame_ids[frame])
+            samples.append(ids)
+            weights.append(count * self.interval)
+
+        document = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+            "name": name,
+            "exporter": "sipac_profile",
+        }
+        with Path(path).open("w", encoding="utf-8") as f:
+            json.dump(document, f)
+
+
+def _install_instrumentation():
+    """
+    Sustituye, una sola vez por proceso, las funciones de
+    ``INSTRUMENTED_FUNCTIONS`` en ``sipac_chain`` (los nodos las buscan en el
+    módulo en cada llamada) por versiones que registran su tiempo en la sesión
+    de ``_current_session``. Sin sesión activa solo añaden una consulta a la
+    ContextVar, y al no restaurarse nunca no hay carreras entre ejecuciones.
+    """
+    global _instrumented
+    with _instrumentation_lock:
+        if _instrumented:
+            return
+        for name, category in INSTRUMENTED_FUNCTIONS.items():
+            setattr(sipac_chain, name, _timed(getattr(sipac_chain, name), category))
+        _instrumented = True
+
+
+def _timed(fn, category: str):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        session = _current_session.get()
+        if session is None:
+            return fn(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            session.add_timing(category, started, time.perf_counter())
+
+    return wrapper
+
+
+def _strip_profiler_frames(stack: List[tuple]) -> Optional[List[tuple]]:
+    """
+    Quita de una pila (del marco más interno al más externo) los marcos de
+    este módulo. Devuelve None si el hilo estaba ejecutando el propio
+    perfilador: un marco del módulo en la cima o llamando a ``tracemalloc``.
+    """
+    profiler_file = Path(__file__).name
+    own = [Path(filename).name == profiler_file for _, filename, _ in stack]
+    if True in own:
+        i = own.index(True)
+        if i == 0 or Path(stack[i - 1][1]).name == "tracemalloc.py":
+            return None
+    return [frame for frame, is_own in zip(stack, own) if not is_own]
+
+
+# ============================================================================
+# SESIÓN DE PERFILADO
+# ============================================================================
+
+
+class ProfileSession:
+    """
+    Acumula los tiempos por categoría y la memoria por nodo de una ejecución.
+
+    Las categorías son ``node:<nombre>``, ``llm_wait``, ``profiler_overhead``
+    (snapshots de tracemalloc) y las de ``INSTRUMENTED_FUNCTIONS``; la
+    sobrecarga de LangGraph se obtiene como el tiempo total menos el tiempo
+    dentro de los nodos y el del propio perfilador.
+
+    ``timings`` suma la duración de cada llamada, así que con llamadas
+    concurrentes (especulativas o de self-consistency) puede superar el tiempo
+    total. Por eso cada medida guarda también su intervalo y el nodo que la
+    originó, y ``breakdown`` trabaja con tiempo de reloj solapado.
+    """
+
+    def __init__(self, trace_memory: bool = False, top_allocations: int = 5):
+        self.trace_memory = trace_memory
+        self.top_allocations = top_allocations
+        self.timings: dict[str, dict] = {}
+        self.memory: dict[str, dict] = {}
+        self._intervals: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def add_timing(self, category: str, started: float, ended: float):
+        """Registra una medida de ``category`` entre dos instantes de ``perf_counter``"""
+        owner = _current_node.get()
+        with self._lock:
+            entry = self.timings.setdefault(category, {"calls": 0, "total_s": 0.0})
+            entry["calls"] += 1
+            entry["total_s"] += ended - started
+            self._intervals.append((category, owner, started, ended))
+
+    def total(self, category: str) -> float:
+        return self.timings.get(category, {}).get("total_s", 0.0)
+
+    def _record_memory(self, name: str, before, after, peak: int):
+        stats = after.compare_to(before, "lineno")
+        with self._lock:
+            entry = self.memory.setdefault(
+                name, {"calls": 0, "size_diff_bytes": 0, "peak_bytes": 0, "top": []}
+            )
+            entry["calls"] += 1
+            entry["size_diff_bytes"] += sum(s.size_diff for s in stats)
+            if peak >= entry["peak_bytes"]:
+                entry["peak_bytes"] = peak
+                entry["top"] = [
+                    {"location": str(s.traceback), "size_diff_bytes": s.size_diff}
+                    for s in stats[: self.top_allocations]
+                ]
+
+    def wrap_node(self, name: str, node):
+        """``node_wrapper`` de ``create_sipac_graph`` que mide tiempo y memoria"""
+
+        def wrapped(state, config: RunnableConfig = None):
+            before = None
+            if self.trace_memory and tracemalloc.is_tracing():
+                snapshot_started = time.perf_counter()
+                tracemalloc.reset_peak()
+                before = tracemalloc.take_snapshot()
+                self.add_timing("profiler_overhead", snapshot_started, time.perf_counter())
+
+            token = _current_node.set(name)
+            started = time.perf_counter()
+            try:
+                return call_node(node, state, config)
+            finally:
+                self.add_timing(f"node:{name}", started, time.perf_counter())
+                _current_node.reset(token)
+                if before is not None:
+                    snapshot_started = time.perf_counter()
+                    peak = tracemalloc.get_traced_memory()[1]
+                    self._record_memory(name, before, tracemalloc.take_snapshot(), peak)
+                    self.add_timing("profiler_overhead", snapshot_started, time.perf_counter())
+
+        wrapped.__name__ = getattr(node, "__name__", name)
+        return wrapped
+
+    @contextmanager
+    def instrument_functions(self):
+        """
+        Cronometra las funciones de ``INSTRUMENTED_FUNCTIONS`` en esta sesión
+        mientras dure el bloque, solo para las llamadas hechas desde el
+        contexto actual (ver ``_install_instrumentation``).
+        """
+        _install_instrumentation()
+        token = _current_session.set(self)
+        try:
+            yield
+        finally:
+            _current_session.reset(token)
+
+    def _spans(self, category: str, owner: Optional[str] = None) -> List[tuple]:
+        return _merge_spans(
+            (started, ended)
+            for cat, who, started, ended in self._intervals
+            if cat == category and (owner is None or who == owner)
+        )
+
+    def breakdown(self, wall_s: float) -> dict:
+        """
+        Reparto del tiempo total entre LangGraph, nodos, prompts, JSON y LLM.
+
+        Todos los valores son tiempo de reloj: las llamadas que se solapan
+        cuentan una sola vez. Cada espera al LLM, prompt o parseo se atribuye
+        al nodo que la lanzó, y solo en la parte en que ese nodo estaba en
+        curso; por ejemplo, una llamada especulativa lanzada por ``agent``
+        que sigue mientras se ejecuta ``validation`` no se descuenta de
+        ninguno de los dos durante ese tramo, pero sí del ``agent`` siguiente
+        mientras la espera.
+        """
+        with self._lock:
+            nodes = sorted(
+                {k.split(":", 1)[1] for k in self.timings if k.startswith("node:")}
+            )
+            node_spans = {name: self._spans(f"node:{name}") for name in nodes}
+            profiler = self._spans("profiler_overhead")
+            in_nodes = _merge_spans(span for spans in node_spans.values() for span in spans)
+
+            breakdown = {
+                "wall_s": wall_s,
+                "langgraph_overhead_s": max(
+                    wall_s - _spans_length(_merge_spans(in_nodes + profiler)), 0.0
+                ),
+                "profiler_overhead_s": _spans_length(profiler),
+            }
+            for category in NODE_SUBCATEGORIES:
+                breakdown[f"{category}_s"] = _spans_length(self._spans(category))
+            breakdown["nodes"] = {}
+
+            for name, spans in node_spans.items():
+                entry = {"wall_s": _spans_length(spans)}
+                owned = []
+                for category in NODE_SUBCATEGORIES:
+                    attributed = _intersect_spans(self._spans(category, owner=name), spans)
+                    entry[f"{category}_s"] = _spans_length(attributed)
+                    owned.extend(attributed)
+                entry["self_s"] = max(
+                    entry["wall_s"] - _spans_length(_merge_spans(owned)), 0.0
+                )
+                breakdown["nodes"][name] = entry
+        return breakdown
+
+
+def _merge_spans(spans) -> List[tuple]:
+    """Une intervalos ``(inicio, fin)`` solapados; devuelve la lista ordenada"""
+    merged: List[list] = []
+    for started, ended in sorted(spans):
+        if merged and started <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], ended)
+        else:
+            merged.append([started, ended])
+    return [tuple(span) for span in merged]
+
+
+def _intersect_spans(a: List[tuple], b: List[tuple]) -> List[tuple]:
+    """Intersección de dos listas de intervalos ya unidas con ``_merge_spans``"""
+    result, i, j = [], 0, 0
+    while i < len(a) and j < len(b):
+        started, ended = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if started < ended:
+            result.append((started, ended))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def _spans_length(spans: List[tuple]) -> float:
+    return sum((ended - started for started, ended in spans), 0.0)
+
+
+class ProfilingLLM:
+    """Envoltorio del LLM que mide el tiempo de espera de cada llamada"""
+
+    def __init__(self, llm, session: ProfileSession):
+        self.llm = llm
+        self.session = session
+
+    def invoke(self, messages, config=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.llm.invoke(messages, config, **kwargs)
+        finally:
+            self.session.add_timing("llm_wait", started, time.perf_counter())
+
+
+# ============================================================================
+# EJECUCIÓN PERFILADA
+# ============================================================================
+
+
+def profile_sipac(
+    initial_state: Optional[dict] = None,
+    config: Optional[RunnableConfig] = None,
+    output_dir: Optional[Path] = None,
+    sample_interval: float = DEFAULT_SAMPLE_INTERVAL,
+    trace_memory: bool = False,
+    profile_id: Optional[str] = None,
+    **run_kwargs,
+) -> tuple[dict, dict]:
+    """
+    Ejecuta SIPAC en modo perfilado.
+
+    Args:
+        initial_state: Estado inicial (opcional)
+        config: Configuración de LangGraph (p. ej. con el ``llm`` a usar)
+        output_dir: Carpeta de los ficheros de perfil
+        sample_interval: Periodo de muestreo de CPU en segundos (0 lo desactiva)
+        trace_memory: Si True, toma snapshots de tracemalloc por nodo. Hace
+            más lenta la ejecución y distorsiona los tiempos: conviene medir
+            la memoria en una ejecución distinta de la de tiempos
+        profile_id: Prefijo de los ficheros generados
+        **run_kwargs: Resto de opciones de ``run_sipac`` (speculative, ...)
+
+    Returns:
+        (estado final, informe de perfilado)
+    """
+    output_dir = Path(output_dir or Path(RESULTS_DIR) / "profiles")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    profile_id = profile_id or uuid.uuid4().hex[:12]
+
+    session = ProfileSession(trace_memory=trace_memory)
+    graph = create_sipac_graph(node_wrapper=session.wrap_node)
+
+    configurable = dict((config or {}).get("configurable", {}))
+    configurable["llm"] = ProfilingLLM(get_llm(config), session)
+    _, sampling_llms = wrap_sampling_llms(
+        config, run_kwargs.get("self_consistency"), lambda llm, slot: ProfilingLLM(llm, session)
+    )
+    if sampling_llms:
+        configurable["sampling_llms"] = sampling_llms
+
+    state = default_initial_state()
+    state.update(initial_state or {})
+
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    sampler = StackSampler(sample_interval) if sample_interval > 0 else None
+    if sampler is not None:
+        sampler.start()
+
+    started = time.perf_counter()
+    try:
+        with session.instrument_functions():
+            final_state = run_sipac(
+                state,
+                stream=False,
+                graph=graph,
+                config={**(config or {}), "configurable": configurable},
+                **run_kwargs,
+            )
+    finally:
+        wall = time.perf_counter() - started
+        if sampler is not None:
+            sampler.stop()
+        if started_tracing:
+            tracemalloc.stop()
+
+    report = {
+        "profile_id": profile_id,
+        "completed": final_state.get("completed", False),
+        "trace_memory": trace_memory,
+        "breakdown": session.breakdown(wall),
+        "timings": session.timings,
+        "memory": session.memory,
+        "files": {},
+    }
+
+    if sampler is not None:
+        folded = output_dir / f"{profile_id}.folded"
+        speedscope = output_dir / f"{profile_id}.speedscope.json"
+        sampler.write_folded(folded)
+        sampler.write_speedscope(speedscope, name=f"SIPAC {profile_id}")
+        report["samples"] = sampler.num_samples
+        report["files"]["folded"] = str(folded)
+        report["files"]["speedscope"] = str(speedscope)
+
+    report_file = output_dir / f"{profile_id}.report.json"
+    report["files"]["report"] = str(report_file)
+    with report_file.open("w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    return final_state, report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Perfilado de una ejecución de SIPAC")
+    parser.add_argument("--replay", default=None, help="Traza a reproducir sin modelo (sipac_trace)")
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--interval", type=float, default=DEFAULT_SAMPLE_INTERVAL)
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Pasada de memoria con tracemalloc (distorsiona los tiempos)",
+    )
+    args = parser.parse_args()
+
+    runs = [(None, None, {})]
+    if args.replay:
+        runs = []
+        for run in read_trace(Path(args.replay)):
+            options = run["run"].get("options", {})
+            runs.append(
+                (
+                    run["run"]["initial_state"],
+                    {"configurable": replay_configurable(run)},
+                    {
+                        "speculative": options.get("speculative", False),
+                        "self_consistency": options.get("self_consistency"),
+                    },
+                )
+            )
+
+    for initial_state, config, run_kwargs in runs:
+        _, report = profile_sipac(
+            initial_state,
+            config,
+            output_dir=args.output_dir,
+            sample_interval=args.interval,
+            trace_memory=args.memory,
+            **run_kwargs,
+        )
+        print(json.dumps(report["breakdown"], indent=2))
+        print(f"Perfil: {report['files']}")
@@ -0,0 +1,485 @@
+"""
+SIPAC - Servicio residente
+Mantiene el grafo compilado y el modelo en caliente, encola trabajos y limita
+las llamadas concurrentes de ``agent_input_node`` a los slots paralelos del
+servidor de inferencia.
+
+Uso:
+    python sipac_service.py --port 8765
+    python sipac_service.py --socket /tmp/sipac.sock
+
+API (JSON):
+    POST /jobs                  Encola un trabajo (cuerpo: estado inicial opcional)
+    GET  /jobs                  Lista los trabajos y su estado
+    GET  /jobs/<id>             Estado y resultado de un trabajo
+    GET  /jobs/<id>/events      Progreso en streaming (NDJSON)
+    GET  /health                Estado del servicio
+"""
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_ollama import ChatOllama
+
+from sipac_assets import AssetIndex
+from sipac_chain import (
+    DEFAULT_MODEL,
+    STEPS,
+    SpeculativePrefetcher,
+    create_sipac_graph,
+    default_initial_state,
+    merge_state_update,
+    serialize_results,
+    with_prefetcher,
+)
+
+# ============================================================================
+# CONCURRENCIA HACIA EL SERVIDOR DE INFERENCIA
+# ============================================================================
+
+# Peticiones que Ollama atiende a la vez por modelo (su valor por defecto es 4)
+DEFAULT_MAX_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+
+
+class BoundedLLM:
+    """
+    Envoltorio de un chat model que limita las llamadas ``invoke`` en vuelo.
+
+    Ollama no tiene API de batch: ``ChatOllama.batch`` solo reparte las
+    peticiones en hilos del cliente, y el agrupamiento real lo hace el
+    servidor con sus slots paralelos (``OLLAMA_NUM_PARALLEL``). Por eso no se
+    forman lotes ni se retienen peticiones: cada llamada se envía en cuanto
+    hay un slot libre, y las que sobrepasan ``max_parallel`` esperan en el
+    cliente en lugar de encolarse en el servidor.
+    """
+
+    def __init__(self, llm, max_parallel: int = DEFAULT_MAX_PARALLEL):
+        self.llm = llm
+        self.max_parallel = max_parallel
+        self._slots = threading.BoundedSemaphore(max_parallel)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests_sent = 0
+
+    def invoke(self, messages: List[BaseMessage], config=None, **kwargs):
+        with self._slots:
+            with self._lock:
+                self.in_flight += 1
+                self.requests_sent += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                return self.llm.invoke(messages, config, **kwargs)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+
+# ============================================================================
+# TRABAJOS
+# ============================================================================
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+# Retención de trabajos terminados (con sus eventos y resultado)
+JOB_TTL_S = 3600
+MAX_FINISHED_JOBS = 1000
+
+
+def serialize_node_output(node_name: str, node_state: dict) -> dict:
+    """Convierte la salida de un nodo en un evento de progreso serializable"""
+    event = {"node": node_name}
+
+    if node_name == "agent" and node_state.get("conversation_history"):
+        entry = node_state["conversation_history"][-1]
+        event["step"] = entry["step"]
+        event["step_name"] = entry["step_name"]
+        event["response"] = entry["response"]
+
+    for key in ("current_step", "validation_error", "retry_count", "completed"):
+        if key in node_state:
+            event[key] = node_state[key]
+
+    if "analysis_results" in node_state:
+        event["analysis_results"] = node_state["analysis_results"]
+
+    return event
+
+
+def serialize_final_state(state: dict) -> dict:
+    """Resultado exportable de un trabajo, con su indicador de finalización"""
+    result = serialize_results(state)
+    result["completed"] = state.get("completed", False)
+    return result
+
+
+class SipacJob:
+    """Trabajo encolado en el servicio, con su estado y eventos de progreso"""
+
+    def __init__(self, initial_state: dict):
+        self.id = uuid.uuid4().hex
+        self.initial_state = initial_state
+        self.status = JOB_QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.events: List[dict] = []
+        self._cond = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in (JOB_COMPLETED, JOB_FAILED)
+
+    def add_event(self, event: dict):
+        with self._cond:
+            self.events.append(event)
+            self._cond.notify_all()
+
+    def finish(self, status: str, result: Optional[dict] = None, error: str = None):
+        with self._cond:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def wait_events(self, start: int, timeout: float = 1.0) -> List[dict]:
+        """Devuelve los eventos a partir de ``start``, esperando si no hay nuevos"""
+        with self._cond:
+            if len(self.events) <= start and not self.done:
+                self._cond.wait(timeout)
+            return self.events[start:]
+
+    def summary(self, include_result: bool = False) -> dict:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "num_events": len(self.events),
+        }
+        if self.events:
+            data["progress"] = self.events[-1]
+        if self.error:
+            data["error"] = self.error
+        if include_result and self.result is not None:
+            data["result"] = self.result
+        return data
+
+
+# ============================================================================
+# SERVICIO
+# ============================================================================
+
+
+class SipacService:
+    """
+    Servicio residente de SIPAC.
+
+    El grafo se compila una sola vez al arrancar y todos los trabajos
+    comparten el mismo ``BoundedLLM``, de modo que las llamadas de varios
+    trabajos concurrentes no superan los slots paralelos del servidor.
+
+    Los trabajos terminados se conservan ``job_ttl_s`` segundos y como mucho
+    ``max_finished_jobs``; después se olvidan y la API responde 404.
+    """
+
+    def __init__(
+        self,
+        llm=None,
+        max_concurrent_jobs: int = 8,
+        max_parallel: int = DEFAULT_MAX_PARALLEL,
+        speculative: bool = False,
+        asset_index=None,
+        job_ttl_s: float = JOB_TTL_S,
+        max_finished_jobs: int = MAX_FINISHED_JOBS,
+    ):
+        if llm is None:
+            llm = ChatOllama(model=DEFAULT_MODEL, temperature=0, keep_alive=-1)
+        self.graph = create_sipac_graph()
+        self.llm = BoundedLLM(llm, max_parallel=max_parallel)
+        self.speculative = speculative
+        self.asset_index = asset_index
+        self.job_ttl_s = job_ttl_s
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs: dict[str, SipacJob] = {}
+        self._jobs_lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[SipacJob]]" = queue.Queue()
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"sipac-worker-{i}", daemon=True)
+            for i in range(max_concurrent_jobs)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def warmup(self):
+        """Carga el modelo en el servidor de inferencia antes de recibir trabajos"""
+        self.llm.invoke([HumanMessage(content="ok")])
+
+    def submit(self, initial_state: Optional[dict] = None) -> SipacJob:
+        state = default_initial_state()
+        if initial_state:
+            state.update(initial_state)
+        job = SipacJob(state)
+        with self._jobs_lock:
+            self._expire_jobs()
+            self.jobs[job.id] = job
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[SipacJob]:
+        with self._jobs_lock:
+            self._expire_jobs()
+            return self.jobs.get(job_id)
+
+    def list_jobs(self) -> List[dict]:
+        with self._jobs_lock:
+            self._expire_jobs()
+            jobs = list(self.jobs.values())
+        return [job.summary() for job in jobs]
+
+    def stats(self) -> dict:
+        with self._jobs_lock:
+            self._expire_jobs()
+            jobs = list(self.jobs.values())
+        counts = {}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "status": "ok",
+            "jobs": counts,
+            "queued": self._queue.qsize(),
+            "llm_requests": self.llm.requests_sent,
+            "llm_in_flight": self.llm.in_flight,
+        }
+
+    def _expire_jobs(self):
+        """Olvida los trabajos terminados caducados o que exceden el máximo (con ``_jobs_lock``)"""
+        finished = sorted(
+            (job for job in self.jobs.values() if job.finished_at is not None),
+            key=lambda job: job.finished_at,
+        )
+        deadline = time.time() - self.job_ttl_s
+        excess = len(finished) - self.max_finished_jobs
+        for i, job in enumerate(finished):
+            if i < excess or job.finished_at < deadline:
+                del self.jobs[job.id]
+
+    def shutdown(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            config = {"configurable": {"llm": self.llm, "asset_index": self.asset_index}}
+            prefetcher = None
+            if self.speculative:
+                prefetcher = SpeculativePrefetcher()
+                config = with_prefetcher(config, prefetcher)
+
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+            try:
+                final_state = merge_state_update({}, job.initial_state)
+                for step_output in self.graph.stream(job.initial_state, config, stream_mode="updates"):
+                    for node_name, node_state in step_output.items():
+                        if not node_state:
+                            continue
+                        job.add_event(serialize_node_output(node_name, node_state))
+                        merge_state_update(final_state, node_state)
+
+                status = JOB_COMPLETED if final_state.get("completed") else JOB_FAILED
+                job.finish(status, result=serialize_final_state(final_state))
+            except Exception as e:
+                job.finish(JOB_FAILED, error=f"{type(e).__name__}: {e}")
+            finally:
+                if prefetcher is not None:
+                    prefetcher.close()
+
+
+# ============================================================================
+# API HTTP
+# ============================================================================
+
+
+def make_handler(service: SipacService):
+    class SipacRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def address_string(self):
+            # En sockets Unix client_address no es una tupla (host, puerto)
+            if isinstance(self.client_address, tuple):
+                return super().address_string()
+            return "unix"
+
+        def _send_json(self, status: int, data):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def _stream_events(self, job: SipacJob):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            sent = 0
+            while True:
+                events = job.wait_events(sent)
+                for event in events:
+                    self._write_chunk(
+                        (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+                    )
+                sent += len(events)
+                if job.done and sent >= len(job.events):
+                    break
+
+            final = {"node": "__end__", "status": job.status}
+            if job.error:
+                final["error"] = job.error
+            self._write_chunk((json.dumps(final, ensure_ascii=False) + "\n").encode("utf-8"))
+            self._write_chunk(b"")
+
+        def do_GET(self):
+            parts = [p for p in self.path.split("?")[0].split("/") if p]
+
+            if parts == ["health"]:
+                return self._send_json(200, service.stats())
+
+            if parts == ["jobs"]:
+                return self._send_json(200, service.list_jobs())
+
+            if len(parts) in (2, 3) and parts[0] == "jobs":
+                job = service.get(parts[1])
+                if job is None:
+                    return self._send_json(404, {"error": "Trabajo no encontrado o caducado"})
+                if len(parts) == 2:
+                    return self._send_json(200, job.summary(include_result=True))
+                if parts[2] == "events":
+                    return self._stream_events(job)
+
+            self._send_json(404, {"error": "Ruta no encontrada"})
+
+        def do_POST(self):
+            parts = [p for p in self.path.split("?")[0].split("/") if p]
+            if parts != ["jobs"]:
+                return self._send_json(404, {"error": "Ruta no encontrada"})
+
+            length = int(self.headers.get("Content-Length", 0))
+            initial_state = {}
+            if length:
+                try:
+                    initial_state = json.loads(self.rfile.read(length))
+                except json.JSONDecodeError as e:
+                    return self._send_json(400, {"error": f"JSON inválido: {e}"})
+                if not isinstance(initial_state, dict):
+                    return self._send_json(400, {"error": "El estado inicial debe ser un objeto JSON"})
+
+            job = service.submit(initial_state)
+            self._send_json(202, {"job_id": job.id, "status": job.status})
+
+    return SipacRequestHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service: SipacService, host: str = "127.0.0.1", port: int = 8765, socket_path: str = None):
+    """Arranca la API HTTP (TCP o socket Unix) hasta recibir Ctrl+C"""
+    handler = make_handler(service)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, handler)
+        where = f"unix:{socket_path}"
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        where = f"http://{host}:{port}"
+
+    print(f"SIPAC service escuchando en {where} ({len(STEPS)} pasos por trabajo)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servicio residente de SIPAC")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="Ruta de un socket Unix en lugar de TCP")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--base-url", default=None, help="URL del servidor Ollama")
+    parser.add_argument("--workers", type=int, default=8, help="Trabajos concurrentes")
+    parser.add_argument(
+        "--max-parallel",
+        type=int,
+        default=DEFAULT_MAX_PARALLEL,
+        help="Llamadas simultáneas al modelo (OLLAMA_NUM_PARALLEL del servidor)",
+    )
+    parser.add_argument(
+        "--job-ttl", type=float, default=JOB_TTL_S, help="Segundos que se conserva un trabajo terminado"
+    )
+    parser.add_argument("--max-finished-jobs", type=int, default=MAX_FINISHED_JOBS)
+    parser.add_argument("--no-warmup", action="store_true")
+    parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="Adelanta la llamada del siguiente paso mientras se valida el actual",
+    )
+    parser.add_argument(
+        "--asset-index",
+        default=None,
+        help="Fichero del índice de normalización de activos (sipac_assets)",
+    )
+    args = parser.parse_args()
+
+    llm = ChatOllama(model=args.model, temperature=0, base_url=args.base_url, keep_alive=-1)
+    service = SipacService(
+        llm,
+        max_concurrent_jobs=args.workers,
+        max_parallel=args.max_parallel,
+        speculative=args.speculative,
+        asset_index=AssetIndex(args.asset_index) if args.asset_index else None,
+        job_ttl_s=args.job_ttl,
+        max_finished_jobs=args.max_finished_jobs,
+    )
+    if not args.no_warmup:
+        service.warmup()
+
+    serve(service, host=args.host, port=args.port, socket_path=args.socket)
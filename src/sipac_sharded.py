@@ -0,0 +1,364 @@
+"""
+SIPAC - Ejecución distribuida por shards
+Reparte un lote de entradas entre varios procesos y varios servidores de
+modelo (Ollama), con enrutado al servidor menos cargado, límite de
+concurrencia por servidor y comprobaciones de salud. Los resultados se
+fusionan en un único fichero JSONL.
+
+Uso:
+    python sipac_sharded.py entradas.json \\
+        --endpoint http://127.0.0.1:11434 --endpoint http://otra-maquina:11434=4 \\
+        --workers 4 --threads 8
+
+Cada ``--endpoint`` admite ``URL`` o ``URL=LIMITE`` (peticiones simultáneas).
+El fichero de entrada es una lista JSON de estados iniciales; la clave
+opcional ``id`` identifica cada entrada en el fichero de resultados.
+"""
+
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Optional
+
+import httpx
+from langchain_ollama import ChatOllama
+
+from sipac_assets import AssetIndex
+from sipac_chain import (
+    DEFAULT_MODEL,
+    RESULTS_DIR,
+    SipacState,
+    create_sipac_graph,
+    default_initial_state,
+    run_sipac,
+    serialize_results,
+)
+
+HEALTH_CHECK_INTERVAL = 5.0
+HEALTH_CHECK_TIMEOUT = 2.0
+ACQUIRE_TIMEOUT = 60.0
+
+
+class NoHealthyEndpointError(RuntimeError):
+    """No hay ningún servidor de modelo sano o con plazas libres"""
+
+# ============================================================================
+# POOL DE SERVIDORES DE MODELO
+# ============================================================================
+
+
+def parse_endpoint(value: str, default_limit: int) -> dict:
+    """Convierte ``URL`` o ``URL=LIMITE`` en la descripción de un servidor"""
+    url, _, limit = value.partition("=")
+    return {
+        "base_url": url.rstrip("/"),
+        "max_concurrency": int(limit) if limit else default_limit,
+    }
+
+
+def check_endpoint_health(base_url: str, timeout: float = HEALTH_CHECK_TIMEOUT) -> bool:
+    """Comprueba que el servidor responde a ``/api/tags``"""
+    try:
+        with urllib.request.urlopen(f"{base_url}/api/tags", timeout=timeout) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+
+class EndpointPool:
+    """
+    Estado compartido entre procesos de los servidores de modelo.
+
+    Las peticiones en curso y la salud de cada servidor viven en un
+    ``multiprocessing.Manager``, de modo que el enrutado al servidor menos
+    cargado y los límites de concurrencia son globales y no por proceso.
+    """
+
+    def __init__(self, endpoints: List[dict], in_flight, healthy, lock):
+        self.endpoints = {e["base_url"]: e for e in endpoints}
+        self.in_flight = in_flight
+        self.healthy = healthy
+        self.lock = lock
+
+    @classmethod
+    def create(cls, manager, endpoints: List[dict]) -> "EndpointPool":
+        in_flight = manager.dict({e["base_url"]: 0 for e in endpoints})
+        healthy = manager.dict({e["base_url"]: True for e in endpoints})
+        return cls(endpoints, in_flight, healthy, manager.Lock())
+
+    def acquire(self, timeout: float = ACQUIRE_TIMEOUT, poll_interval: float = 0.05) -> str:
+        """
+        Reserva una plaza en el servidor sano menos cargado. Si todos están
+        ocupados espera hasta ``timeout``; si ninguno está sano falla en el acto.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                healthy = [url for url in self.endpoints if self.healthy.get(url, False)]
+                if not healthy:
+                    raise NoHealthyEndpointError("Ningún servidor de modelo está disponible")
+
+                best, best_load = None, None
+                for url in healthy:
+                    endpoint = self.endpoints[url]
+                    current = self.in_flight[url]
+                    if current >= endpoint["max_concurrency"]:
+                        continue
+                    load = current / endpoint["max_concurrency"]
+                    if best is None or load < best_load:
+                        best, best_load = url, load
+                if best is not None:
+                    self.in_flight[best] = self.in_flight[best] + 1
+                    return best
+            if time.monotonic() >= deadline:
+                raise NoHealthyEndpointError(
+                    f"Ningún servidor de modelo tuvo plazas libres en {timeout}s"
+                )
+            time.sleep(poll_interval)
+
+    def release(self, base_url: str):
+        with self.lock:
+            self.in_flight[base_url] = self.in_flight[base_url] - 1
+
+    def mark_unhealthy(self, base_url: str):
+        self.healthy[base_url] = False
+
+    def refresh_health(self):
+        for url in self.endpoints:
+            self.healthy[url] = check_endpoint_health(url)
+
+    def snapshot(self) -> dict:
+        return {
+            url: {"healthy": self.healthy[url], "in_flight": self.in_flight[url]}
+            for url in self.endpoints
+        }
+
+
+class HealthChecker(threading.Thread):
+    """Hilo del proceso principal que revisa periódicamente los servidores"""
+
+    def __init__(self, pool: EndpointPool, interval: float = HEALTH_CHECK_INTERVAL):
+        super().__init__(name="sipac-health", daemon=True)
+        self.pool = pool
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.pool.refresh_health()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class RoutedLLM:
+    """
+    Chat model que envía cada llamada al servidor elegido por el ``EndpointPool``.
+
+    Si un servidor falla por un error de conexión se marca como no sano y la
+    llamada se reintenta en otro.
+    """
+
+    def __init__(self, pool: EndpointPool, model: str = DEFAULT_MODEL, temperature: float = 0):
+        self.pool = pool
+        self.model = model
+        self.temperature = temperature
+        self._clients: dict[str, ChatOllama] = {}
+        self._clients_lock = threading.Lock()
+
+    def _client(self, base_url: str) -> ChatOllama:
+        with self._clients_lock:
+            if base_url not in self._clients:
+                self._clients[base_url] = ChatOllama(
+                    model=self.model, temperature=self.temperature, base_url=base_url
+                )
+            return self._clients[base_url]
+
+    def invoke(self, messages, config=None, **kwargs):
+        attempts = len(self.pool.endpoints)
+        for attempt in range(attempts):
+            base_url = self.pool.acquire()
+            try:
+                return self._client(base_url).invoke(messages, config, **kwargs)
+            except (httpx.ConnectError, httpx.TimeoutException, ConnectionError):
+                self.pool.mark_unhealthy(base_url)
+                if attempt == attempts - 1:
+                    raise
+            finally:
+                self.pool.release(base_url)
+
+
+# ============================================================================
+# PROCESOS DE TRABAJO
+# ============================================================================
+
+# Estado por proceso: se inicializa una vez con ``_init_worker``
+_WORKER_GRAPH = None
+_WORKER_LLM: Optional[RoutedLLM] = None
+_WORKER_ASSET_INDEX: Optional[AssetIndex] = None
+
+
+def _init_worker(pool: EndpointPool, model: str, asset_index_path: Optional[str]):
+    global _WORKER_GRAPH, _WORKER_LLM, _WORKER_ASSET_INDEX
+    _WORKER_GRAPH = create_sipac_graph()
+    _WORKER_LLM = RoutedLLM(pool, model=model)
+    if asset_index_path:
+        # Todos los procesos comparten el fichero; los ids se asignan con bloqueo
+        _WORKER_ASSET_INDEX = AssetIndex(Path(asset_index_path))
+
+
+def _run_one(item: dict) -> dict:
+    config = {"configurable": {"llm": _WORKER_LLM, "asset_index": _WORKER_ASSET_INDEX}}
+    started = time.perf_counter()
+    try:
+        final_state = run_sipac(item["state"], stream=False, graph=_WORKER_GRAPH, config=config)
+        record = serialize_results(final_state)
+        record["completed"] = final_state.get("completed", False)
+    except Exception as e:
+        record = {"completed": False, "error": f"{type(e).__name__}: {e}"}
+    record["id"] = item["id"]
+    record["elapsed_s"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def _run_shard(shard: List[dict], threads: int) -> List[dict]:
+    """Ejecuta un shard en un proceso, con varias ejecuciones concurrentes por hilo"""
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(_run_one, shard))
+
+
+# ============================================================================
+# EJECUTOR
+# ============================================================================
+
+
+def prepare_inputs(inputs: List[dict]) -> List[dict]:
+    """Normaliza las entradas: estado inicial completo más un identificador"""
+    items = []
+    for i, raw in enumerate(inputs):
+        state = default_initial_state()
+        state.update({k: v for k, v in raw.items() if k in SipacState.__annotations__})
+        items.append({"id": raw.get("id", i), "state": state})
+    return items
+
+
+def partition(items: List[dict], num_shards: int) -> List[List[dict]]:
+    """Reparto round-robin para equilibrar los shards"""
+    shards = [items[i::num_shards] for i in range(num_shards)]
+    return [shard for shard in shards if shard]
+
+
+def run_sharded(
+    inputs: List[dict],
+    endpoints: List[dict],
+    output_file: Path,
+    workers: int = 4,
+    threads: int = 4,
+    shard_size: int = 16,
+    model: str = DEFAULT_MODEL,
+    asset_index_path: Optional[Path] = None,
+) -> dict:
+    """
+    Ejecuta SIPAC para cada entrada repartiendo el trabajo entre procesos y
+    servidores de modelo, y fusiona los resultados en ``output_file`` (JSONL).
+
+    Args:
+        inputs: Lista de estados iniciales (con ``id`` opcional)
+        endpoints: Servidores de modelo, ``{"base_url", "max_concurrency"}``
+        output_file: Fichero JSONL donde se escriben los resultados
+        workers: Número de procesos
+        threads: Ejecuciones concurrentes dentro de cada proceso
+        shard_size: Entradas por shard enviado a un proceso
+        model: Modelo a usar en todos los servidores
+        asset_index_path: Índice de normalización de activos compartido (opcional)
+
+    Returns:
+        Resumen de la ejecución
+    """
+    items = prepare_inputs(inputs)
+    num_shards = max(workers, -(-len(items) // shard_size))
+    shards = partition(items, num_shards)
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    completed = failed = 0
+
+    with multiprocessing.Manager() as manager:
+        pool = EndpointPool.create(manager, endpoints)
+        pool.refresh_health()
+        checker = HealthChecker(pool)
+        checker.start()
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(pool, model, str(asset_index_path) if asset_index_path else None),
+            ) as executor, output_file.open("w", encoding="utf-8") as f:
+                futures = [executor.submit(_run_shard, shard, threads) for shard in shards]
+                for future in as_completed(futures):
+                    # Un único escritor: el proceso principal
+                    for record in future.result():
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                        if record.get("completed"):
+                            completed += 1
+                        else:
+                            failed += 1
+                    f.flush()
+        finally:
+            checker.stop()
+            endpoint_status = pool.snapshot()
+
+    return {
+        "total": len(items),
+        "completed": completed,
+        "failed": failed,
+        "elapsed_s": round(time.perf_counter() - started, 3),
+        "endpoints": endpoint_status,
+        "output_file": str(output_file),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ejecución distribuida de SIPAC")
+    parser.add_argument("inputs", help="Fichero JSON con la lista de estados iniciales")
+    parser.add_argument(
+        "--endpoint",
+        action="append",
+        default=[],
+        help="Servidor Ollama (URL o URL=LIMITE); se puede repetir",
+    )
+    parser.add_argument("--default-limit", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--shard-size", type=int, default=16)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--asset-index", default=None, help="Índice de normalización de activos")
+    args = parser.parse_args()
+
+    with open(args.inputs, encoding="utf-8") as f:
+        inputs = json.load(f)
+
+    endpoints = [
+        parse_endpoint(e, args.default_limit)
+        for e in (args.endpoint or ["http://127.0.0.1:11434"])
+    ]
+    output_file = Path(args.output) if args.output else Path(RESULTS_DIR) / "sipac_sharded_results.jsonl"
+
+    summary = run_sharded(
+        inputs,
+        endpoints,
+        output_file,
+        workers=args.workers,
+        threads=args.threads,
+        shard_size=args.shard_size,
+        model=args.model,
+        asset_index_path=Path(args.asset_index) if args.asset_index else None,
+    )
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
@@ -0,0 +1,474 @@
+"""
+SIPAC - Grabación de trazas y reproducción offline
+Graba, para cada ejecución, las entradas y los deltas de estado de cada nodo
+y las respuestas en bruto del LLM en un fichero JSONL comprimido con gzip.
+El motor de reproducción vuelve a ejecutar ``create_sipac_graph()`` a partir
+de la traza sustituyendo el LLM por las respuestas grabadas, sin servidor de
+modelo, para perfilar y hacer pruebas de regresión de rendimiento offline.
+
+Uso:
+    python sipac_trace.py record trazas.jsonl.gz --runs 10
+    python sipac_trace.py replay trazas.jsonl.gz --repeat 5
+
+Formato (una línea JSON por registro):
+    {"type": "run",  "run_id", "started_at", "initial_state", "options"}
+    {"type": "node", "run_id", "seq", "node", "input", "delta", "elapsed_s"}
+    {"type": "llm",  "run_id", "seq", "key", "slot", "response", "elapsed_s"}
+
+``slot`` es el índice del candidato en las llamadas de self-consistency
+(``null`` en las del modelo principal).
+    {"type": "end",  "run_id", "completed", "elapsed_s"}
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.runnables import RunnableConfig
+
+from sipac_chain import (
+    ACCUMULATED_KEYS,
+    call_node,
+    create_sipac_graph,
+    default_initial_state,
+    get_asset_index,
+    get_llm,
+    run_sipac,
+    wrap_sampling_llms,
+)
+from sipac_assets import normalize_asset
+
+
+class ReplayMismatchError(RuntimeError):
+    """La ejecución reproducida pide una respuesta que no está en la traza"""
+
+
+# ============================================================================
+# SERIALIZACIÓN
+# ============================================================================
+
+
+def to_jsonable(value):
+    """Convierte estado/deltas (incluidos mensajes de LangChain) a JSON"""
+    if isinstance(value, BaseMessage):
+        return message_to_dict(value)
+    if isinstance(value, dict):
+        return {k: to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    return value
+
+
+def messages_key(messages: List[BaseMessage]) -> str:
+    """Huella de una petición al LLM, para emparejarla al reproducir"""
+    payload = json.dumps(
+        [(m.type, m.content) for m in messages], ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def node_input(state: dict) -> dict:
+    """Entrada compacta de un nodo: el estado sin los canales acumulativos"""
+    data = {k: v for k, v in state.items() if k not in ACCUMULATED_KEYS}
+    data["num_messages"] = len(state.get("messages", []))
+    return to_jsonable(data)
+
+
+# ============================================================================
+# GRABACIÓN
+# ============================================================================
+
+
+class TraceWriter:
+    """Escritor de trazas seguro entre hilos (gzip, JSONL, en modo append)"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = gzip.open(self.path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TraceRun:
+    """Contexto de grabación de una ejecución, pasado en ``config["configurable"]["trace"]``"""
+
+    def __init__(self, writer: TraceWriter, run_id: Optional[str] = None):
+        self.writer = writer
+        self.run_id = run_id or uuid.uuid4().hex
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def next_seq(self) -> int:
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def record(self, record_type: str, **data):
+        self.writer.write({"type": record_type, "run_id": self.run_id, **data})
+
+
+class RecordingLLM:
+    """
+    Envoltorio del LLM que graba cada respuesta junto a la huella del prompt y,
+    para los modelos de muestreo, el índice del candidato (``slot``)
+    """
+
+    def __init__(self, llm, trace: TraceRun, slot: Optional[int] = None):
+        self.llm = llm
+        self.trace = trace
+        self.slot = slot
+
+    def invoke(self, messages, config=None, **kwargs):
+        started = time.perf_counter()
+        response = self.llm.invoke(messages, config, **kwargs)
+        self.trace.record(
+            "llm",
+            seq=self.trace.next_seq(),
+            key=messages_key(messages),
+            slot=self.slot,
+            response=message_to_dict(response),
+            elapsed_s=round(time.perf_counter() - started, 6),
+        )
+        return response
+
+
+def traced_node(name: str, node):
+    """``node_wrapper`` de ``create_sipac_graph`` que graba entrada y delta de cada nodo"""
+    def wrapped(state, config: RunnableConfig = None):
+        trace = (config or {}).get("configurable", {}).get("trace")
+        if trace is None:
+            return call_node(node, state, config)
+
+        seq = trace.next_seq()
+        inputs = node_input(state)
+        started = time.perf_counter()
+        delta = call_node(node, state, config)
+        trace.record(
+            "node",
+            seq=seq,
+            node=name,
+            input=inputs,
+            delta=to_jsonable(delta),
+            elapsed_s=round(time.perf_counter() - started, 6),
+        )
+        return delta
+
+    wrapped.__name__ = getattr(node, "__name__", name)
+    return wrapped
+
+
+def create_traced_graph():
+    """Grafo de SIPAC con los nodos instrumentados para grabar trazas"""
+    return create_sipac_graph(node_wrapper=traced_node)
+
+
+def record_sipac(
+    writer: TraceWriter,
+    initial_state: Optional[dict] = None,
+    graph=None,
+    config: Optional[RunnableConfig] = None,
+    speculative: bool = False,
+    self_consistency: Optional[dict | bool] = None,
+) -> dict:
+    """
+    Ejecuta SIPAC grabando la traza completa de la ejecución en ``writer``.
+
+    ``graph`` debe haberse creado con ``create_traced_graph()`` para que se
+    graben los nodos; si no se indica, se crea uno.
+    """
+    if graph is None:
+        graph = create_traced_graph()
+    state = default_initial_state()
+    state.update(initial_state or {})
+
+    trace = TraceRun(writer)
+    configurable = dict((config or {}).get("configurable", {}))
+    configurable["llm"] = RecordingLLM(get_llm(config), trace)
+
+    settings, sampling_llms = wrap_sampling_llms(
+        config, self_consistency, lambda llm, slot: RecordingLLM(llm, trace, slot)
+    )
+    if sampling_llms:
+        configurable["sampling_llms"] = sampling_llms
+
+    configurable["trace"] = trace
+    asset_index = get_asset_index(config)
+
+    trace.record(
+        "run",
+        started_at=time.time(),
+        initial_state=to_jsonable(state),
+        options={
+            "speculative": speculative,
+            "self_consistency": settings,
+            "asset_index": str(asset_index.path) if asset_index is not None else None,
+        },
+    )
+
+    started = time.perf_counter()
+    final_state = run_sipac(
+        state,
+        stream=False,
+        graph=graph,
+        config={**(config or {}), "configurable": configurable},
+        speculative=speculative,
+        self_consistency=settings,
+    )
+    trace.record(
+        "end",
+        completed=final_state.get("completed", False),
+        elapsed_s=round(time.perf_counter() - started, 6),
+    )
+    return final_state
+
+
+# ============================================================================
+# REPRODUCCIÓN
+# ============================================================================
+
+
+def read_trace(path: Path) -> Iterator[dict]:
+    """
+    Lee una traza y devuelve sus ejecuciones agrupadas:
+    ``{"run", "nodes", "llm", "end"}``
+    """
+    runs: dict[str, dict] = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            run = runs.setdefault(
+                record["run_id"], {"run": None, "nodes": [], "llm": [], "end": None}
+            )
+            if record["type"] == "run":
+                run["run"] = record
+            elif record["type"] == "node":
+                run["nodes"].append(record)
+            elif record["type"] == "llm":
+                run["llm"].append(record)
+            elif record["type"] == "end":
+                run["end"] = record
+                yield runs.pop(record["run_id"])
+
+    # Ejecuciones sin registro final (p. ej. interrumpidas)
+    for run in runs.values():
+        if run["run"] is not None:
+            yield run
+
+
+class ReplayLLM:
+    """
+    Sustituye al LLM devolviendo las respuestas grabadas.
+
+    Las respuestas se emparejan por la huella del prompt y, para un mismo
+    prompt, en el orden en que se grabaron. Los candidatos de
+    self-consistency comparten prompt, así que cada uno se reproduce con su
+    propio ``ReplayLLM`` (ver ``replay_configurable``) y no importa en qué
+    orden terminen. Si se pide más veces un prompt de las grabadas se lanza
+    ``ReplayMismatchError``.
+    """
+
+    def __init__(self, llm_records: List[dict]):
+        self._responses: dict[str, deque] = {}
+        for record in sorted(llm_records, key=lambda r: r["seq"]):
+            self._responses.setdefault(record["key"], deque()).append(record["response"])
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def invoke(self, messages, config=None, **kwargs):
+        key = messages_key(messages)
+        with self._lock:
+            self.calls += 1
+            queue = self._responses.get(key)
+            if not queue:
+                raise ReplayMismatchError(f"No hay respuesta grabada para el prompt {key}")
+            response = queue.popleft()
+        return messages_from_dict([response])[0]
+
+
+class ReplayAssetIndex:
+    """
+    Sustituye al índice de activos (``sipac_assets.AssetIndex``) devolviendo
+    los ``activo_id`` grabados en los deltas de ``validation``.
+
+    No lee ni modifica el índice real: el resultado de la reproducción no
+    depende de su estado actual y nunca se le añaden activos.
+    """
+
+    def __init__(self, node_records: List[dict]):
+        self._ids: dict[str, int] = {}
+        for record in node_records:
+            delta = record.get("delta") or {}
+            if record.get("node") == "validation" and "activo_id" in delta:
+                for text, asset_id in zip(delta["activo_especifico"], delta["activo_id"]):
+                    self._ids[normalize_asset(text)] = asset_id
+
+    def lookup(self, text: str) -> Optional[int]:
+        return self._ids.get(normalize_asset(text))
+
+    def resolve(self, text: str) -> int:
+        asset_id = self.lookup(text)
+        if asset_id is None:
+            raise ReplayMismatchError(f"No hay activo_id grabado para {text!r}")
+        return asset_id
+
+    def resolve_many(self, texts) -> List[int]:
+        return [self.resolve(text) for text in texts]
+
+
+def replay_configurable(run: dict) -> dict:
+    """``config["configurable"]`` que reproduce una ejecución grabada sin modelo ni índice"""
+    by_slot: dict[Optional[int], List[dict]] = {}
+    for record in run["llm"]:
+        by_slot.setdefault(record.get("slot"), []).append(record)
+
+    replay_llm = ReplayLLM(by_slot.pop(None, []))
+    # Un candidato que falló al grabar no tiene respuestas: vuelve a fallar
+    settings = run["run"].get("options", {}).get("self_consistency") or {}
+    num_slots = settings.get("n", max(by_slot, default=-1) + 1)
+    sampling_llms = [ReplayLLM(by_slot.get(slot, [])) for slot in range(num_slots)]
+    configurable = {"llm": replay_llm, "sampling_llms": sampling_llms or [replay_llm]}
+    if run["run"].get("options", {}).get("asset_index"):
+        configurable["asset_index"] = ReplayAssetIndex(run["nodes"])
+    return configurable
+
+
+def _comparable_delta(delta: dict) -> dict:
+    return {k: v for k, v in delta.items() if k != "messages"}
+
+
+def replay_run(run: dict, graph=None, verify: bool = True) -> dict:
+    """
+    Reproduce una ejecución grabada sin servidor de modelo.
+
+    Args:
+        run: Ejecución tal y como la devuelve ``read_trace``
+        graph: Grafo ya compilado a reutilizar (opcional)
+        verify: Si True, compara los deltas de cada nodo con los grabados
+
+    Returns:
+        Resumen con el tiempo de ejecución y las diferencias encontradas
+    """
+    header = run["run"]
+    options = header.get("options", {})
+    configurable = replay_configurable(run)
+    replay_llms = {id(llm): llm for llm in [configurable["llm"], *configurable["sampling_llms"]]}
+
+    recorder = None
+    if verify:
+        recorder = _ReplayRecorder()
+        configurable["trace"] = recorder
+        if graph is None:
+            graph = create_traced_graph()
+
+    started = time.perf_counter()
+    final_state = run_sipac(
+        header["initial_state"],
+        stream=False,
+        graph=graph,
+        config={"configurable": configurable},
+        speculative=options.get("speculative", False),
+        self_consistency=options.get("self_consistency"),
+    )
+    elapsed = time.perf_counter() - started
+
+    mismatches = []
+    if verify:
+        recorded = [(n["node"], _comparable_delta(n["delta"])) for n in run["nodes"]]
+        replayed = [(n["node"], _comparable_delta(n["delta"])) for n in recorder.nodes]
+        if len(recorded) != len(replayed):
+            mismatches.append(
+                f"Número de nodos distinto: grabados {len(recorded)}, reproducidos {len(replayed)}"
+            )
+        for i, (expected, actual) in enumerate(zip(recorded, replayed)):
+            if expected != actual:
+                mismatches.append(f"Nodo {i + 1} ({expected[0]}): delta distinto")
+
+    return {
+        "run_id": header["run_id"],
+        "completed": final_state.get("completed", False),
+        "recorded_elapsed_s": (run["end"] or {}).get("elapsed_s"),
+        "replay_elapsed_s": round(elapsed, 6),
+        "llm_calls": sum(llm.calls for llm in replay_llms.values()),
+        "mismatches": mismatches,
+    }
+
+
+class _ReplayRecorder:
+    """Sustituto de ``TraceRun`` que guarda en memoria los nodos reproducidos"""
+
+    def __init__(self):
+        self.nodes: List[dict] = []
+        self._lock = threading.Lock()
+
+    def next_seq(self) -> int:
+        with self._lock:
+            return len(self.nodes) + 1
+
+    def record(self, record_type: str, **data):
+        if record_type == "node":
+            with self._lock:
+                self.nodes.append(data)
+
+
+def replay_trace(path: Path, repeat: int = 1, verify: bool = True) -> List[dict]:
+    """Reproduce todas las ejecuciones de una traza ``repeat`` veces"""
+    graph = create_traced_graph() if verify else create_sipac_graph()
+    results = []
+    for run in read_trace(path):
+        for _ in range(repeat):
+            results.append(replay_run(run, graph=graph, verify=verify))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trazas de SIPAC: grabación y reproducción")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="Ejecuta SIPAC grabando la traza")
+    record_parser.add_argument("trace")
+    record_parser.add_argument("--runs", type=int, default=1)
+    record_parser.add_argument("--speculative", action="store_true")
+
+    replay_parser = subparsers.add_parser("replay", help="Reproduce una traza sin modelo")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--repeat", type=int, default=1)
+    replay_parser.add_argument("--no-verify", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "record":
+        graph = create_traced_graph()
+        with TraceWriter(Path(args.trace)) as writer:
+            for i in range(args.runs):
+                final_state = record_sipac(writer, graph=graph, speculative=args.speculative)
+                print(f"Ejecución {i + 1}/{args.runs}: completed={final_state.get('completed')}")
+        print(f"Traza grabada en: {args.trace}")
+    else:
+        results = replay_trace(Path(args.trace), repeat=args.repeat, verify=not args.no_verify)
+        for result in results:
+            print(json.dumps(result, ensure_ascii=False))
+        total = sum(r["replay_elapsed_s"] for r in results)
+        print(f"\n{len(results)} ejecuciones reproducidas en {total:.3f}s")
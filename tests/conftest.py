@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Los módulos de SIPAC son scripts en src/, no un paquete instalable
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
@@ -0,0 +1,103 @@
+import socket
+import threading
+import time
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_ollama import ChatOllama
+
+from ollama_stub import start_stub_server
+from sipac_service import BoundedLLM, SipacService
+
+
+class SlowLLM:
+    """Modelo de prueba que registra cuántas llamadas hay en curso a la vez"""
+
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, messages, config=None, **kwargs):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self._lock:
+            self.active -= 1
+        return AIMessage(content="ok")
+
+
+def test_bounded_llm_limits_concurrent_calls():
+    inner = SlowLLM()
+    llm = BoundedLLM(inner, max_parallel=2)
+
+    threads = [
+        threading.Thread(target=llm.invoke, args=([HumanMessage(content="hola")],))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert inner.max_active == 2
+    assert llm.max_in_flight == 2
+    assert llm.requests_sent == 8
+    assert llm.in_flight == 0
+
+
+def test_bounded_llm_sends_without_delay():
+    llm = BoundedLLM(SlowLLM(delay=0), max_parallel=1)
+
+    started = time.perf_counter()
+    for _ in range(20):
+        llm.invoke([HumanMessage(content="hola")])
+
+    assert time.perf_counter() - started < 0.1
+
+
+@pytest.fixture
+def stub_llm():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server, _ = start_stub_server(port)
+    yield ChatOllama(model="qwen3:8b", temperature=0, base_url=f"http://127.0.0.1:{port}")
+    server.shutdown()
+
+
+def _wait_done(job, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while not job.done or job.finished_at is None:
+        assert time.monotonic() < deadline, "el trabajo no terminó a tiempo"
+        job.wait_events(len(job.events), timeout=0.05)
+
+
+def test_service_keeps_at_most_max_finished_jobs(stub_llm):
+    service = SipacService(stub_llm, max_concurrent_jobs=1, max_finished_jobs=2)
+    try:
+        jobs = [service.submit() for _ in range(4)]
+        for job in jobs:
+            _wait_done(job)
+
+        assert [service.get(job.id) for job in jobs[:2]] == [None, None]
+        assert service.get(jobs[3].id).status == "completed"
+        assert len(service.list_jobs()) == 2
+    finally:
+        service.shutdown()
+
+
+def test_service_expires_finished_jobs_after_ttl(stub_llm):
+    service = SipacService(stub_llm, max_concurrent_jobs=1, job_ttl_s=0.2)
+    try:
+        job = service.submit()
+        _wait_done(job)
+        assert service.get(job.id) is job
+
+        time.sleep(0.3)
+        assert service.get(job.id) is None
+        assert service.stats()["jobs"] == {}
+    finally:
+        service.shutdown()
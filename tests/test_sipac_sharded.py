@@ -0,0 +1,68 @@
+import json
+import socket
+import time
+
+from ollama_stub import start_stub_server
+from sipac_sharded import run_sharded
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _endpoint(port: int, limit: int = 2) -> dict:
+    return {"base_url": f"http://127.0.0.1:{port}", "max_concurrency": limit}
+
+
+def test_run_sharded_across_stub_servers_and_dead_endpoint(tmp_path):
+    ports = [_free_port(), _free_port()]
+    dead_port = _free_port()
+    servers = [start_stub_server(port, delay=0.01) for port in ports]
+
+    try:
+        output_file = tmp_path / "results.jsonl"
+        summary = run_sharded(
+            [{"id": f"empresa-{i}"} for i in range(12)],
+            [_endpoint(ports[0]), _endpoint(ports[1]), _endpoint(dead_port)],
+            output_file,
+            workers=2,
+            threads=2,
+            shard_size=4,
+        )
+    finally:
+        for server, _ in servers:
+            server.shutdown()
+
+    assert summary["total"] == 12
+    assert summary["completed"] == 12
+    assert summary["failed"] == 0
+    assert summary["endpoints"][f"http://127.0.0.1:{dead_port}"]["healthy"] is False
+
+    # Ambos servidores vivos reciben trabajo (4 llamadas por ejecución)
+    requests = [stats["requests"] for _, stats in servers]
+    assert all(count > 0 for count in requests)
+    assert sum(requests) == 12 * 4
+
+    records = [json.loads(line) for line in output_file.read_text(encoding="utf-8").splitlines()]
+    assert sorted(r["id"] for r in records) == sorted(f"empresa-{i}" for i in range(12))
+    assert all(r["activos"]["tipo_generico"] == [3, 11] for r in records)
+
+
+def test_run_sharded_fails_fast_without_healthy_endpoints(tmp_path):
+    started = time.monotonic()
+    summary = run_sharded(
+        [{"id": i} for i in range(3)],
+        [_endpoint(_free_port())],
+        tmp_path / "results.jsonl",
+        workers=1,
+        threads=1,
+    )
+
+    assert time.monotonic() - started < 20
+    assert summary["completed"] == 0
+    assert summary["failed"] == 3
+
+    records = [json.loads(line) for line in (tmp_path / "results.jsonl").read_text().splitlines()]
+    assert all("NoHealthyEndpointError" in r["error"] for r in records)
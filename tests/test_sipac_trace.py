@@ -0,0 +1,84 @@
+import json
+import random
+import re
+import time
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from ollama_stub import STUB_RESPONSES
+from sipac_trace import (
+    ReplayLLM,
+    ReplayMismatchError,
+    TraceWriter,
+    create_traced_graph,
+    messages_key,
+    read_trace,
+    record_sipac,
+    replay_trace,
+)
+
+ACTIVOS = [
+    {"tipo_generico": 3, "activo_especifico": "Tienda online", "importancia": 5, "tipo_ci": "capital tecnológico"},
+    {"tipo_generico": 11, "activo_especifico": "Sistema CRM", "importancia": 4, "tipo_ci": "capital organizativo"},
+    {"tipo_generico": 7, "activo_especifico": "Cartera de clientes", "importancia": 3, "tipo_ci": "capital de negocio"},
+]
+
+
+class CandidateLLM:
+    """Modelo de prueba: cada candidato propone activos distintos y tarda un tiempo aleatorio"""
+
+    def __init__(self, slot: int):
+        self.slot = slot
+
+    def invoke(self, messages, config=None, **kwargs):
+        step = int(re.search(r"PASO (\d+) de", messages[0].content).group(1))
+        time.sleep(random.uniform(0, 0.02))
+        if step != 4:
+            return AIMessage(content=STUB_RESPONSES[step])
+        # Candidatos distintos que empatan en apoyo: el desempate depende del orden
+        activos = [ACTIVOS[self.slot % 3], ACTIVOS[(self.slot + 1) % 3]]
+        return AIMessage(
+            content=json.dumps(
+                [dict(a, importancia=1 + self.slot) for a in activos], ensure_ascii=False
+            )
+        )
+
+
+def test_self_consistency_replay_is_deterministic(tmp_path):
+    trace_path = tmp_path / "trace.jsonl.gz"
+    graph = create_traced_graph()
+    with TraceWriter(trace_path) as writer:
+        for strategy in ("best", "consensus"):
+            for _ in range(3):
+                config = {
+                    "configurable": {
+                        "llm": CandidateLLM(0),
+                        "sampling_llms": [CandidateLLM(slot) for slot in range(5)],
+                    }
+                }
+                record_sipac(
+                    writer,
+                    graph=graph,
+                    config=config,
+                    self_consistency={"n": 5, "strategy": strategy},
+                )
+
+    runs = list(read_trace(trace_path))
+    assert {r["slot"] for run in runs for r in run["llm"]} == {None, 0, 1, 2, 3, 4}
+
+    results = replay_trace(trace_path, repeat=3)
+    assert len(results) == 18
+    assert all(r["completed"] for r in results)
+    assert [r["mismatches"] for r in results] == [[]] * 18
+
+
+def test_replay_llm_raises_when_calls_exceed_recording():
+    messages = [HumanMessage(content="hola")]
+    llm = ReplayLLM(
+        [{"seq": 1, "key": messages_key(messages), "response": {"type": "ai", "data": {"content": "ok"}}}]
+    )
+
+    assert llm.invoke(messages).content == "ok"
+    with pytest.raises(ReplayMismatchError):
+        llm.invoke(messages)